@@ -0,0 +1,14 @@
+from lazycache.lists import CachedList
+
+
+class NumberCachedList(CachedList):
+    """Items are (number, text) tuples, identified by their numbers."""
+
+    def identify_items(self, items):
+        return [item[0] for item in items]
+
+    def make_cache_keys(self, identifiers):
+        return ['BenchmarkItem:%d' % identifier for identifier in identifiers]
+
+    def rebuild_items(self, identifiers):
+        return [(identifier, u'item %d' % identifier) for identifier in identifiers]
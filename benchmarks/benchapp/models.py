@@ -0,0 +1,10 @@
+from django.contrib.auth.models import User
+from django.db import models
+
+from lazymodel import ModelWithCaching
+
+
+class Article(ModelWithCaching):
+    slug = models.SlugField(unique=True)
+    title = models.CharField(max_length=100)
+    author = models.ForeignKey(User, null=True)
@@ -0,0 +1,134 @@
+import cPickle as pickle
+import time
+
+from threading import Lock
+
+from django.core.cache.backends.base import BaseCache
+
+
+class FakeMemcachedCache(BaseCache):
+    """
+    An in-process cache backend that behaves like memcached, for benchmarks.
+
+    Values are pickled on the way in and unpickled on the way out, outside
+    of any lock, so the cost of serialization is measured and values can be
+    cached while another value is being pickled (which CachedList does).
+    Like memcached, values larger than 1MB are silently not stored.
+
+    The LATENCY option adds a delay (in seconds) to every call, to simulate
+    a network round trip. The *_many methods only pay for one round trip,
+    so the benefit of batching shows up in the results.
+
+    Example:
+        CACHES = {
+            'default': {
+                'BACKEND': 'fakememcached.FakeMemcachedCache',
+                'OPTIONS': {'LATENCY': 0.0002},
+            },
+        }
+
+    """
+
+    max_value_size = 1024 * 1024
+
+    def __init__(self, location, params):
+        super(FakeMemcachedCache, self).__init__(params)
+        self.latency = float(params.get('OPTIONS', {}).get('LATENCY', 0))
+        self._data = {}
+        self._lock = Lock()
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return timeout and time.time() + timeout or None
+
+    def _load(self, key, now):
+        item = self._data.get(key)
+        if item is not None:
+            expires, data = item
+            if expires is None or expires > now:
+                return data
+            self._data.pop(key, None)
+
+    def _store(self, key, value, timeout):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) <= self.max_value_size:
+            self._data[key] = (self._expires(timeout), data)
+            return True
+        self._data.pop(key, None)
+        return False
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        self._round_trip()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_value_size:
+            return False
+        with self._lock:
+            if self._load(key, time.time()) is not None:
+                return False
+            self._data[key] = (self._expires(timeout), data)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        self._round_trip()
+        data = self._load(key, time.time())
+        if data is None:
+            return default
+        return pickle.loads(data)
+
+    def get_many(self, keys, version=None):
+        self._round_trip()
+        now = time.time()
+        result = {}
+        for key in keys:
+            data = self._load(self.make_key(key, version), now)
+            if data is not None:
+                result[key] = pickle.loads(data)
+        return result
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        self._round_trip()
+        self._store(key, value, timeout)
+
+    def set_many(self, data, timeout=None, version=None):
+        self._round_trip()
+        for key, value in data.items():
+            self._store(self.make_key(key, version), value, timeout)
+
+    def delete(self, key, version=None):
+        self._round_trip()
+        self._data.pop(self.make_key(key, version), None)
+
+    def delete_many(self, keys, version=None):
+        self._round_trip()
+        for key in keys:
+            self._data.pop(self.make_key(key, version), None)
+
+    def has_key(self, key, version=None):
+        self._round_trip()
+        return self._load(self.make_key(key, version), time.time()) is not None
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version)
+        self._round_trip()
+        with self._lock:
+            data = self._load(key, time.time())
+            if data is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(data) + delta
+            expires = self._data[key][0]
+            self._data[key] = (expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            return value
+
+    def clear(self):
+        self._data.clear()
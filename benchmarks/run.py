@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hot paths of lazycache and lazymodel.
+
+This runs against an in-memory SQLite database and either the locmem cache
+or a fake memcached backend (see fakememcached.py), so the results do not
+depend on any external services. The results can be saved as JSON and then
+compared against later runs to catch performance regressions.
+
+Usage:
+    python benchmarks/run.py --cache=fakememcached --save=baseline.json
+    python benchmarks/run.py --cache=fakememcached --compare=baseline.json
+
+Only compare results from the same machine, cache backend and options.
+The exit status is 1 if any benchmark got slower than the threshold.
+
+"""
+
+import cPickle as pickle
+import json
+import optparse
+import os
+import platform
+import sys
+import threading
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCHMARKS_DIR), BENCHMARKS_DIR]
+
+CACHES = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fakememcached': {
+        'BACKEND': 'fakememcached.FakeMemcachedCache',
+    },
+}
+
+
+def configure(options):
+    """Configure Django. This must happen before lazymodel is imported."""
+
+    from django.conf import settings
+
+    cache = dict(CACHES[options.cache])
+    if options.latency:
+        cache['OPTIONS'] = {'LATENCY': options.latency}
+
+    # Each shard is a separate cache of the same type.
+    caches = {'default': cache}
+    shard_aliases = ['shard%d' % index for index in range(options.shards)]
+    for alias in shard_aliases:
+        caches[alias] = dict(cache, LOCATION=alias)
+    extra_settings = {}
+    if shard_aliases:
+        extra_settings['LAZYMODEL_CACHES'] = {'aliases': shard_aliases}
+
+    settings.configure(
+        DEBUG=False,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': options.database,
+            },
+        },
+        CACHES=caches,
+        INSTALLED_APPS=(
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'lazymodel',
+            'benchapp',
+        ),
+        VERSION='1',
+        CACHE_KEY_VERSIONS={'model_cache': '1'},
+        **extra_settings
+    )
+
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+class Benchmark(object):
+    """
+    A function to be timed. It is called with the number of operations
+    to perform, and it should perform them in a loop. If a setup function
+    is provided, it is called before every repeat and is not timed.
+
+    """
+
+    def __init__(self, name, func, number, setup=None):
+        self.name = name
+        self.func = func
+        self.number = number
+        self.setup = setup
+
+    def run(self, repeat):
+        timings = []
+        for i in range(repeat):
+            if self.setup:
+                self.setup()
+            start = time.time()
+            self.func(self.number)
+            timings.append((time.time() - start) / self.number)
+        timings.sort()
+        return {
+            'number': self.number,
+            'repeat': repeat,
+            'best': timings[0],
+            'median': timings[len(timings) // 2],
+            'ops_per_second': timings[0] and 1 / timings[0] or None,
+        }
+
+
+class SlowCache(object):
+    """
+    Wraps a cache backend and adds a delay to get_many, to simulate the
+    network round trip to memcached. Threads can run while waiting.
+
+    """
+
+    def __init__(self, cache, latency):
+        self.cache = cache
+        self.latency = latency
+
+    def get_many(self, keys):
+        time.sleep(self.latency)
+        return self.cache.get_many(keys)
+
+    def set_many(self, *args, **kwargs):
+        return self.cache.set_many(*args, **kwargs)
+
+
+def run_threads(thread_count, func, n):
+    """Perform n operations split across threads."""
+    threads = [
+        threading.Thread(target=func, args=(n // thread_count,))
+        for i in range(thread_count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_benchmarks(options):
+
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from django.db.models.signals import post_save
+
+    from benchapp.lists import NumberCachedList
+    from benchapp.models import Article
+    from lazycache import LazyCache
+    from lazycache.hotkeys import HotKeys
+    from lazycache.local import LocalCache
+    from lazymodel import LazyModel
+    from lazymodel.backend import lazymodel_cache
+    from lazymodel.invalidation import lazymodel_invalidation
+    from lazymodel.utils import lookup_cache_key, model_cache_key
+
+    number = options.number
+    count = max(number, 100)
+
+    author = User.objects.create(username='author')
+    articles = [
+        Article.objects.create(slug='article-%d' % i, title='Article %d' % i, author=author)
+        for i in range(count)
+    ]
+    pks = [article.pk for article in articles]
+    slugs = [article.slug for article in articles]
+
+    def clear_cache():
+        cache.clear()
+        if lazymodel_cache.cache is not cache:
+            lazymodel_cache.cache.clear()
+
+    def cycle(values, n):
+        return (values[i % len(values)] for i in xrange(n))
+
+    def warm_cache():
+        clear_cache()
+        for pk, slug in zip(pks, slugs):
+            Article.objects.get(pk=pk)
+            Article.objects.get(slug=slug)
+
+    def lazymodel_hit(n):
+        for pk in cycle(pks, n):
+            bool(LazyModel(Article, pk))
+
+    def lazymodel_miss(n):
+        for pk in cycle(pks, n):
+            bool(LazyModel(Article, pk))
+
+    def get_by_pk_hit(n):
+        for pk in cycle(pks, n):
+            Article.objects.get(pk=pk)
+
+    def get_by_pk_miss(n):
+        for pk in cycle(pks, n):
+            Article.objects.get(pk=pk)
+
+    def get_by_lookup_hit(n):
+        for slug in cycle(slugs, n):
+            Article.objects.get(slug=slug)
+
+    def get_by_lookup_miss(n):
+        for slug in cycle(slugs, n):
+            Article.objects.get(slug=slug)
+
+    def get_list(n):
+        # Each operation is one object, fetched in batches of 100.
+        for start in xrange(0, n, 100):
+            Article.objects.get_list(pks[start % count:start % count + min(100, n - start)])
+
+    def make_model_cache_key(n):
+        for pk in cycle(pks, n):
+            model_cache_key(Article, pk)
+
+    def make_lookup_cache_key(n):
+        for slug in cycle(slugs, n):
+            lookup_cache_key(Article, slug=slug)
+
+    def invalidate(n):
+        for article in cycle(articles, n):
+            post_save.send(sender=Article, instance=article, created=False)
+
+    def invalidate_deferred(n):
+        with lazymodel_invalidation.deferred():
+            invalidate(n)
+
+    def invalidate_commit_on_success(n):
+        with lazymodel_invalidation.commit_on_success():
+            invalidate(n)
+
+    # Miss benchmarks only run through each key once per repeat,
+    # so they can only perform as many operations as there are rows.
+    benchmarks = [
+        Benchmark('lazymodel.hit', lazymodel_hit, number, setup=warm_cache),
+        Benchmark('lazymodel.miss', lazymodel_miss, min(number, count), setup=clear_cache),
+        Benchmark('rowcache.get_pk.hit', get_by_pk_hit, number, setup=warm_cache),
+        Benchmark('rowcache.get_pk.miss', get_by_pk_miss, min(number, count), setup=clear_cache),
+        Benchmark('rowcache.get_lookup.hit', get_by_lookup_hit, number, setup=warm_cache),
+        Benchmark('rowcache.get_lookup.miss', get_by_lookup_miss, min(number, count), setup=clear_cache),
+        Benchmark('rowcache.get_list.hit', get_list, number, setup=warm_cache),
+        Benchmark('rowcache.get_list.miss', get_list, min(number, count), setup=clear_cache),
+        Benchmark('keys.model_cache_key', make_model_cache_key, number),
+        Benchmark('keys.lookup_cache_key', make_lookup_cache_key, number),
+        Benchmark('invalidation.post_save', invalidate, number, setup=warm_cache),
+        Benchmark('invalidation.deferred', invalidate_deferred, number, setup=warm_cache),
+        Benchmark('invalidation.commit_on_success', invalidate_commit_on_success, number, setup=warm_cache),
+    ]
+
+    for size in options.sizes:
+
+        items = [(i, u'item %d' % i) for i in xrange(size)]
+        cached_list = NumberCachedList(items)
+        packed = pickle.dumps(cached_list, pickle.HIGHEST_PROTOCOL)
+
+        # Pickling a CachedList also caches every item with set_many.
+        def pack(n, cached_list=cached_list):
+            for i in xrange(n):
+                pickle.dumps(cached_list, pickle.HIGHEST_PROTOCOL)
+
+        # Unpacking gets every item with get_many on first access.
+        def cache_items(cached_list=cached_list):
+            pickle.dumps(cached_list, pickle.HIGHEST_PROTOCOL)
+
+        def unpack(n, packed=packed):
+            for i in xrange(n):
+                list(pickle.loads(packed))
+
+        # Reading the first page only unpacks the items that it needs.
+        def first_page(n, packed=packed):
+            for i in xrange(n):
+                pickle.loads(packed)[:20]
+
+        # Unpacking after the items have expired rebuilds all of them.
+        def rebuild(n, packed=packed):
+            for i in xrange(n):
+                cache.clear()
+                list(pickle.loads(packed))
+
+        # Larger lists run fewer times so the suite finishes quickly.
+        list_number = max(1, min(number, 100000 // size))
+        benchmarks.extend([
+            Benchmark('cachedlist.%d.pack' % size, pack, list_number),
+            Benchmark('cachedlist.%d.unpack' % size, unpack, list_number, setup=cache_items),
+            Benchmark('cachedlist.%d.first_page' % size, first_page, list_number, setup=cache_items),
+            Benchmark('cachedlist.%d.rebuild' % size, rebuild, list_number),
+        ])
+
+    # Threads unpacking unrelated lists should not wait for each other,
+    # so the throughput should scale with the number of threads.
+    items = [(i, u'item %d' % i) for i in xrange(100)]
+    cached_list = NumberCachedList(items)
+    packed = pickle.dumps(cached_list, pickle.HIGHEST_PROTOCOL)
+    slow_cache = SlowCache(cache, 0.001)
+
+    def cache_items():
+        pickle.dumps(cached_list, pickle.HIGHEST_PROTOCOL)
+
+    def unpack_slowly(n):
+        for i in xrange(n):
+            unpacked = pickle.loads(packed)
+            unpacked.cache_backend = slow_cache
+            list(unpacked)
+
+    for thread_count in (1, 2, 4, 8):
+        def contention(n, thread_count=thread_count):
+            run_threads(thread_count, unpack_slowly, n)
+        benchmarks.append(Benchmark('contention.%d_threads' % thread_count, contention, 200, setup=cache_items))
+
+    # Reading one popular key over and over, which HotKeys keeps locally.
+    plain_cache = LazyCache(cache)
+    hot_cache = LazyCache(cache, hot_keys=HotKeys(LocalCache(), threshold=100, sample_rate=0.1))
+
+    def read_hot_key(n, lazy_cache):
+        for i in xrange(n):
+            lazy_cache.get('benchmark:hot')
+
+    def cache_hot_key():
+        hot_cache.hot_keys.clear()
+        hot_cache.set('benchmark:hot', articles[0])
+
+    benchmarks.extend([
+        Benchmark('hotkeys.off', lambda n: read_hot_key(n, plain_cache), number, setup=cache_hot_key),
+        Benchmark('hotkeys.on', lambda n: read_hot_key(n, hot_cache), number, setup=cache_hot_key),
+    ])
+
+    # Values over the 1MB memcached limit are only cached when chunked.
+    big_value = os.urandom(3 * 1024 * 1024)
+    chunked_cache = LazyCache(cache, chunk_size=1000000)
+
+    def set_big_value(n):
+        for i in xrange(n):
+            chunked_cache.set('benchmark:big', big_value)
+
+    def get_big_value(n):
+        for i in xrange(n):
+            chunked_cache.get('benchmark:big')
+
+    benchmarks.extend([
+        Benchmark('chunks.set', set_big_value, min(number, 100)),
+        Benchmark('chunks.get', get_big_value, min(number, 100), setup=lambda: set_big_value(1)),
+    ])
+
+    return benchmarks
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the best timings of results against a baseline. Returns a list
+    of (name, ratio, regressed) tuples for benchmarks found in both.
+
+    """
+    comparison = []
+    for name, result in sorted(results['benchmarks'].items()):
+        previous = baseline['benchmarks'].get(name)
+        if previous and previous['best']:
+            ratio = result['best'] / previous['best']
+            comparison.append((name, ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def main():
+
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark names...]')
+    parser.add_option('--cache', choices=sorted(CACHES), default='locmem',
+                      help='cache backend: %s (default: %%default)' % ', '.join(sorted(CACHES)))
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds added to every fakememcached request (default: %default)')
+    parser.add_option('--shards', type='int', default=0,
+                      help='spread the row cache over this many caches (default: %default)')
+    parser.add_option('--database', default=':memory:',
+                      help='SQLite database file (default: %default)')
+    parser.add_option('--number', type='int', default=1000,
+                      help='operations per repeat (default: %default)')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='repeats of each benchmark (default: %default)')
+    parser.add_option('--sizes', default='10,1000,100000',
+                      help='CachedList sizes (default: %default)')
+    parser.add_option('--save', metavar='FILE',
+                      help='write the results to a JSON file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results against a JSON file')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='slowdown that counts as a regression (default: %default)')
+    options, names = parser.parse_args()
+    options.sizes = [int(size) for size in options.sizes.split(',') if size]
+
+    configure(options)
+
+    import django
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'cache': options.cache,
+            'latency': options.latency,
+            'shards': options.shards,
+        },
+        'benchmarks': {},
+    }
+
+    for benchmark in get_benchmarks(options):
+        if names and not any(benchmark.name.startswith(name) for name in names):
+            continue
+        result = benchmark.run(options.repeat)
+        results['benchmarks'][benchmark.name] = result
+        sys.stdout.write('%-32s %12.2f us %12.0f ops/s\n' % (
+            benchmark.name,
+            result['best'] * 1000000,
+            result['ops_per_second'] or 0,
+        ))
+
+    if options.save:
+        with open(options.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        sys.stdout.write('\nCompared with %s:\n' % options.compare)
+        regressions = 0
+        for name, ratio, regressed in compare(results, baseline, options.threshold):
+            regressions += regressed
+            sys.stdout.write('%-32s %11.2fx%s\n' % (name, ratio, regressed and '  REGRESSION' or ''))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
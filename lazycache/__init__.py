@@ -1,3 +1,23 @@
+import logging
+import math
+import random
+import threading
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+from lazycache.stats import CacheStats
+
+
 class Missed(object):
     pass
 
@@ -10,17 +30,235 @@ class RaiseKeyError:
     pass
 
 
+class Envelope(object):
+    """
+    Wraps a cached value along with when it expires, how many seconds it
+    took to create, and when it becomes stale. These are used to recompute
+    the value before it expires.
+
+    """
+
+    __slots__ = ('value', 'expires', 'delta', 'stale')
+
+    def __init__(self, value, expires, delta, stale=None):
+        self.value = value
+        self.expires = expires
+        self.delta = delta
+        self.stale = stale
+
+    def __reduce__(self):
+        return (Envelope, (self.value, self.expires, self.delta, self.stale))
+
+
+class Compressed(object):
+    """A compressed, pickled value, along with the name of the codec used."""
+
+    __slots__ = ('codec', 'data')
+
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.data = data
+
+    def __reduce__(self):
+        return (Compressed, (self.codec, self.data))
+
+
+class Chunked(object):
+    """
+    Stored in place of a value that was too big to store in one key. The
+    pickled (and possibly compressed) value is split into count chunks,
+    with keys that include a random token so that setting the value again
+    does not overwrite chunks that another process is still reading.
+
+    """
+
+    __slots__ = ('codec', 'token', 'count', 'length', 'checksum')
+
+    def __init__(self, codec, token, count, length, checksum):
+        self.codec = codec
+        self.token = token
+        self.count = count
+        self.length = length
+        self.checksum = checksum
+
+    def __reduce__(self):
+        return (Chunked, (self.codec, self.token, self.count, self.length, self.checksum))
+
+    def get_keys(self, key):
+        return ['%s:chunk:%s:%d' % (key, self.token, index) for index in xrange(self.count)]
+
+
+class DictCache(object):
+    """
+    Provides the Django cache methods that LazyCache uses, for a dictionary
+    or other object that only supports dictionary-like access. Timeouts
+    are ignored.
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def add(self, key, value, timeout=None, **kwargs):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def get(self, key, default=None, **kwargs):
+        try:
+            return self.data[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys, **kwargs):
+        data = {}
+        for key in keys:
+            try:
+                data[key] = self.data[key]
+            except KeyError:
+                pass
+        return data
+
+    def set(self, key, value, timeout=None, **kwargs):
+        self.data[key] = value
+
+    def set_many(self, data, timeout=None, **kwargs):
+        for key, value in data.items():
+            self.data[key] = value
+
+    def delete(self, key, **kwargs):
+        try:
+            del self.data[key]
+        except KeyError:
+            pass
+
+    def delete_many(self, keys, **kwargs):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        self.data.clear()
+
+
+# The LazyCache made by get_lazy_cache for each cache object,
+# along with the cache object to keep its id from being reused.
+_lazy_caches = {}
+
+
+def get_lazy_cache(cache):
+    """
+    Returns a LazyCache for a cache backend, which can be a LazyCache,
+    a Django cache, or a dictionary-like object (see DictCache).
+
+    Cache objects are long-lived, so the same LazyCache is returned every
+    time for the same cache object. Dictionaries are often made for a single
+    request, so they get a new LazyCache every time, which is cheap, and
+    they are not kept alive afterwards.
+
+    """
+    if isinstance(cache, LazyCache):
+        return cache
+    if not hasattr(cache, 'get_many'):
+        return LazyCache(DictCache(cache))
+    try:
+        return _lazy_caches[id(cache)][1]
+    except KeyError:
+        return _lazy_caches.setdefault(id(cache), (cache, LazyCache(cache)))[1]
+
+
 class LazyCache(object):
-    """Wraps a Django cache object to provide more features."""
+    """
+    Wraps a Django cache object to provide more features.
+
+    If a local_cache (see lazycache.local.LocalCache) is provided, then it is
+    used as an in-process cache in front of the main cache. Values are added
+    to it whenever they are read from or written to the main cache, and
+    removed from it when they are deleted.
+
+    If stale_timeout and refresh_pool (see lazycache.pool.WorkerPool) are
+    provided, then values become stale after stale_timeout seconds, which
+    should be less than the normal timeout. When get_or_set finds a stale
+    value, it returns it immediately and recreates it in the background.
+
+    The methods starting with "a" (aget, aset, etc.) run the normal methods
+    in the executor (see lazycache.pool.WorkerPool) and return an AsyncResult
+    straight away. This allows several cache requests to be in progress at
+    once. Call result.get() to wait for the result.
+
+    If a serializer is provided, then its dumps method is called with each
+    value before it is stored, and its loads method is called with each
+    stored value when it is read. The loads method can raise a ValueError
+    if the stored value can no longer be used, which is treated as a miss.
+
+    If compress_threshold is provided, then values that are bigger than that
+    many bytes when pickled are compressed before being sent to the cache.
+    This uses lz4 if it is installed, otherwise zlib. Compressed values are
+    recognised when they are read, so this can be enabled or disabled without
+    affecting values that are already cached. The number of values compressed
+    and the number of bytes saved are kept in compressed_values and
+    compressed_bytes_saved.
+
+    If chunk_size is provided, then values that are bigger than that many
+    bytes when pickled (and compressed) are split into chunks, which are
+    stored in their own keys. The value's key holds a small manifest with a
+    checksum, and the chunks are read back with one get_many request. If
+    any chunk is missing then the value is treated as a miss. Memcached
+    ignores values over 1MB by default, so use a chunk_size a little under
+    that (e.g. 1000000) to allow for the key and memcached's own overhead.
+    Chunks are not removed when the value is deleted, so they are left to
+    expire or be evicted. The number of values split into chunks is kept in
+    chunked_values.
+
+    If negative_timeout is provided, then None values (used for things that
+    do not exist) are cached for that many seconds at most, so they can be
+    cached briefly without hiding new objects for long. Use a local_cache
+    to serve repeated misses without going to the cache at all.
+
+    If hot_keys (see lazycache.hotkeys.HotKeys) is provided, then it samples
+    the keys that are read, and keeps the values of the most popular ones in
+    this process for a few seconds. This takes load off the cache servers
+    that hold those keys. Deleting keys removes them from every process, in
+    the same way as for the local_cache. Use get_hot_keys() to see them.
+
+    Usage is recorded in stats (see lazycache.stats.CacheStats), including
+    hits and misses for each key namespace, and the time spent waiting for
+    the cache. Call stats.snapshot() to get the data.
+
+    """
 
     missed = Missed()
 
-    def __init__(self, cache, default_timeout=None):
+    # Options for get_or_set. See its docstring for details.
+    lock_timeout = 10
+    lock_wait = 5
+    lock_poll_interval = 0.05
+    recompute_beta = 1.0
+
+    def __init__(self, cache, default_timeout=None, local_cache=None,
+                 stale_timeout=None, refresh_pool=None, executor=None,
+                 serializer=None, compress_threshold=None, stats=None,
+                 negative_timeout=None, hot_keys=None, chunk_size=None):
         self.cache = cache
         self.default_timeout = default_timeout
+        self.local_cache = local_cache
+        self.stale_timeout = stale_timeout
+        self.refresh_pool = refresh_pool
+        self.executor = executor
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self.compressed_values = 0
+        self.compressed_bytes_saved = 0
+        self.chunk_size = chunk_size
+        self.chunked_values = 0
+        self.stats = stats is None and CacheStats() or stats
+        self.negative_timeout = negative_timeout
+        self.hot_keys = hot_keys
+        self._locks = threading.local()
+        self._counter_lock = threading.Lock()
 
     def __getattr__(self, name):
-        return getattr(self, self.cache, name)
+        return getattr(self.cache, name)
 
     def __getitem__(self, key):
         return self.get(key, default=RaiseKeyError)
@@ -31,33 +269,327 @@ class LazyCache(object):
     def __setitem__(self, key, value):
         self.set(key, value)
 
-    def _prepare_value(self, value):
+    def _get_timeout(self, value, timeout):
+        """Returns the timeout to use for a value."""
+        if value is None and self.negative_timeout:
+            if not timeout or timeout > self.negative_timeout:
+                return self.negative_timeout
+        return timeout
+
+    def _prepare_value(self, key, value, timeout, delta=None):
         if value is None:
             value = Null
+        elif self.serializer is not None:
+            value = self.serializer.dumps(value)
+        if timeout and (delta is not None or self.stale_timeout):
+            now = time.time()
+            if self.stale_timeout and self.stale_timeout < timeout:
+                stale = now + self.stale_timeout
+            else:
+                stale = None
+            value = Envelope(value, now + timeout, delta, stale)
         return value
 
     def _restore_value(self, key, value):
+        """
+        Returns the original value from a stored value,
+        or the "missed" object if it can no longer be used.
+
+        """
+        if isinstance(value, Envelope):
+            value = value.value
         if value is Null:
             return None
-        if value is RaiseKeyError:
-            raise KeyError('"%s" was not found in the cache.' % key)
+        if self.serializer is not None:
+            try:
+                value = self.serializer.loads(value)
+            except ValueError:
+                return self.missed
+        return value
+
+    def _encode_value(self, key, value):
+        """
+        Returns the value to store for a prepared value, which is compressed
+        if it is big enough to be worth it, along with a dict of chunks to
+        store first if it is too big to store in one key.
+
+        """
+        if not self.compress_threshold and not self.chunk_size and not self.stats.record_sizes:
+            return value, {}
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.stats.record_size(len(data))
+        codec = None
+        if self.compress_threshold and len(data) > self.compress_threshold:
+            if lz4 is not None:
+                compressed_codec, compressed_data = 'lz4', lz4.compress(data)
+            else:
+                compressed_codec, compressed_data = 'zlib', zlib.compress(data)
+            saved = len(data) - len(compressed_data)
+            if saved > 0:
+                with self._counter_lock:
+                    self.compressed_values += 1
+                    self.compressed_bytes_saved += saved
+                codec, data = compressed_codec, compressed_data
+        if self.chunk_size and len(data) > self.chunk_size:
+            return self._split_value(key, codec, data)
+        if codec is not None:
+            return Compressed(codec, data), {}
+        return value, {}
+
+    def _split_value(self, key, codec, data):
+        """Returns the manifest and chunks for a value that is too big."""
+        chunk_size = self.chunk_size
+        count = (len(data) + chunk_size - 1) // chunk_size
+        token = '%08x' % random.getrandbits(32)
+        manifest = Chunked(codec, token, count, len(data), zlib.crc32(data) & 0xffffffff)
+        chunks = {}
+        for index, chunk_key in enumerate(manifest.get_keys(key)):
+            chunks[chunk_key] = data[index * chunk_size:(index + 1) * chunk_size]
+        with self._counter_lock:
+            self.chunked_values += 1
+        return manifest, chunks
+
+    def _decode_data(self, key, codec, data):
+        """
+        Returns the value from pickled and possibly compressed data, or the
+        "missed" object if it was compressed with a codec that is not
+        available.
+
+        """
+        if codec == 'zlib':
+            data = zlib.decompress(data)
+        elif codec == 'lz4' and lz4 is not None:
+            data = lz4.decompress(data)
+        elif codec is not None:
+            logging.warning('Cannot decompress %r using codec %r' % (key, codec))
+            return self.missed
+        return pickle.loads(data)
+
+    def _decode_value(self, key, value):
+        """
+        Returns the prepared value from a value in the cache, or the "missed"
+        object if it cannot be used. Chunked values are joined separately.
+
+        """
+        if isinstance(value, Compressed):
+            return self._decode_data(key, value.codec, value.data)
         return value
 
-    def add(self, key, value, timeout=0, **kwargs):
+    def _join_chunks(self, manifests, **kwargs):
+        """
+        Get the chunks of values that were split by _split_value, using one
+        request for all of them. Returns a dict of the values that could be
+        put back together, leaving out any with missing or damaged chunks.
+
+        """
+        chunk_keys = {}
+        for key, manifest in manifests.items():
+            chunk_keys[key] = manifest.get_keys(key)
+        with self.stats.timer('get_many'):
+            chunks = self.cache.get_many([chunk_key for keys in chunk_keys.values() for chunk_key in keys], **kwargs)
+        result = {}
+        for key, manifest in manifests.items():
+            try:
+                data = ''.join([chunks[chunk_key] for chunk_key in chunk_keys[key]])
+            except KeyError:
+                self.stats.incr_key(key, 'missing_chunks')
+                continue
+            if len(data) != manifest.length or zlib.crc32(data) & 0xffffffff != manifest.checksum:
+                logging.warning('Chunks of %r do not match the checksum' % key)
+                continue
+            value = self._decode_data(key, manifest.codec, data)
+            if value is not self.missed:
+                result[key] = value
+        return result
+
+    def _cache_add(self, key, value, timeout, **kwargs):
+        value, chunks = self._encode_value(key, value)
+        if chunks:
+            with self.stats.timer('set_many'):
+                self.cache.set_many(chunks, timeout=timeout, **kwargs)
+        with self.stats.timer('add'):
+            added = self.cache.add(key, value, timeout=timeout, **kwargs)
+        if chunks and not added:
+            with self.stats.timer('delete_many'):
+                self.cache.delete_many(list(chunks), **kwargs)
+        return added
+
+    def _cache_get(self, key, **kwargs):
+        with self.stats.timer('get'):
+            value = self.cache.get(key, default=self.missed, **kwargs)
+        if isinstance(value, Chunked):
+            return self._join_chunks({key: value}, **kwargs).get(key, self.missed)
+        return self._decode_value(key, value)
+
+    def _cache_get_many(self, keys, **kwargs):
+        with self.stats.timer('get_many'):
+            data = self.cache.get_many(keys, **kwargs)
+        result = {}
+        manifests = {}
+        for key, value in data.items():
+            if isinstance(value, Chunked):
+                manifests[key] = value
+                continue
+            value = self._decode_value(key, value)
+            if value is not self.missed:
+                result[key] = value
+        if manifests:
+            result.update(self._join_chunks(manifests, **kwargs))
+        return result
+
+    def _cache_set(self, key, value, timeout, **kwargs):
+        value, chunks = self._encode_value(key, value)
+        if chunks:
+            with self.stats.timer('set_many'):
+                self.cache.set_many(chunks, timeout=timeout, **kwargs)
+        with self.stats.timer('set'):
+            return self.cache.set(key, value, timeout=timeout, **kwargs)
+
+    def _cache_set_many(self, data, timeout, **kwargs):
+        # Chunks are stored before the values that refer to them,
+        # so a value is never found without its chunks.
+        encoded_data = {}
+        chunks = {}
+        for key, value in data.items():
+            encoded_data[key], value_chunks = self._encode_value(key, value)
+            chunks.update(value_chunks)
+        if chunks:
+            with self.stats.timer('set_many'):
+                self.cache.set_many(chunks, timeout=timeout, **kwargs)
+        with self.stats.timer('set_many'):
+            return self.cache.set_many(encoded_data, timeout=timeout, **kwargs)
+
+    def _submit(self, func, *args, **kwargs):
+        if self.executor is None:
+            from lazycache.pool import WorkerPool
+            self.executor = WorkerPool()
+        return self.executor.submit(func, *args, **kwargs)
+
+    def aget(self, key, default=None, **kwargs):
+        return self._submit(self.get, key, default, **kwargs)
+
+    def aget_many(self, keys, **kwargs):
+        return self._submit(self.get_many, list(keys), **kwargs)
+
+    def aget_or_miss(self, key, miss=False):
+        return self._submit(self.get_or_miss, key, miss)
+
+    def aset(self, key, value, timeout=None, **kwargs):
+        return self._submit(self.set, key, value, timeout, **kwargs)
+
+    def aset_many(self, data, timeout=None, **kwargs):
+        return self._submit(self.set_many, dict(data), timeout, **kwargs)
+
+    def add(self, key, value, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.default_timeout
+        timeout = self._get_timeout(value, timeout)
         value = self._prepare_value(key, value, timeout)
-        return self.cache.add(key, value, timeout=timeout, **kwargs)
+        added = self._cache_add(key, value, timeout, **kwargs)
+        if added:
+            if self.local_cache is not None:
+                self.local_cache.set(key, value, timeout)
+            if self.hot_keys is not None:
+                self.hot_keys.invalidate([key], bump=False)
+        return added
+
+    def delete(self, key, **kwargs):
+        if self.local_cache is not None:
+            self.local_cache.invalidate(key)
+        if self.hot_keys is not None:
+            self.hot_keys.invalidate([key], bump=self.local_cache is None)
+        self.stats.incr_key(key, 'deletes')
+        with self.stats.timer('delete'):
+            self.cache.delete(key, **kwargs)
+
+    def delete_many(self, keys, **kwargs):
+        keys = list(keys)
+        if self.local_cache is not None:
+            self.local_cache.invalidate_many(keys)
+        if self.hot_keys is not None:
+            self.hot_keys.invalidate(keys, bump=self.local_cache is None)
+        self.stats.incr_keys(keys, 'deletes')
+        with self.stats.timer('delete_many'):
+            self.cache.delete_many(keys, **kwargs)
+
+    def _get_prepared(self, key, **kwargs):
+        """
+        Returns the value from the cache as it was prepared by _prepare_value,
+        or the "missed" object if it was not found.
+
+        """
+        if self.hot_keys is not None:
+            value = self.hot_keys.get(key, default=self.missed)
+            if value is not self.missed:
+                self.stats.incr_key(key, 'pinned_hits')
+                return value
+        if self.local_cache is not None:
+            value = self.local_cache.get(key, default=self.missed)
+            if value is not self.missed:
+                self.stats.incr_key(key, 'local_hits')
+                return value
+        value = self._cache_get(key, **kwargs)
+        if value is not self.missed:
+            if self.local_cache is not None:
+                self.local_cache.set(key, value)
+            if self.hot_keys is not None:
+                self.hot_keys.record(key, value)
+        return value
+
+    def _set_prepared(self, key, value, timeout, **kwargs):
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, timeout)
+        if self.hot_keys is not None:
+            self.hot_keys.invalidate([key], bump=False)
+        return self._cache_set(key, value, timeout, **kwargs)
+
+    def get_hot_keys(self):
+        """Returns the hot keys and their estimated read counts, hottest first."""
+        if self.hot_keys is None:
+            return []
+        return self.hot_keys.keys()
 
     def get(self, key, default=None, **kwargs):
-        value = self.cache.get(key, default=default, **kwargs)
-        value = self._restore_value(key, value)
+        value = self._get_prepared(key, **kwargs)
+        if value is not self.missed:
+            value = self._restore_value(key, value)
+        self.stats.incr_key(key, value is self.missed and 'misses' or 'hits')
+        if value is self.missed:
+            if default is RaiseKeyError:
+                raise KeyError('"%s" was not found in the cache.' % key)
+            value = default
         return value
 
     def get_many(self, keys, **kwargs):
-        data = self.cache.get_many(keys, **kwargs)
+        keys = list(keys)
+        data = {}
+        remaining_keys = keys
+        if self.hot_keys is not None and remaining_keys:
+            pinned_data = self.hot_keys.get_many(remaining_keys)
+            if pinned_data:
+                self.stats.incr_keys(pinned_data, 'pinned_hits')
+                data.update(pinned_data)
+                remaining_keys = [key for key in remaining_keys if key not in pinned_data]
+        if self.local_cache is not None and remaining_keys:
+            local_data = self.local_cache.get_many(remaining_keys)
+            self.stats.incr_keys(local_data, 'local_hits')
+            data.update(local_data)
+            remaining_keys = [key for key in remaining_keys if key not in local_data]
+        if remaining_keys:
+            remaining_data = self._cache_get_many(remaining_keys, **kwargs)
+            if self.local_cache is not None:
+                self.local_cache.set_many(remaining_data)
+            if self.hot_keys is not None:
+                for key, value in remaining_data.items():
+                    self.hot_keys.record(key, value)
+            data.update(remaining_data)
         restored_data = {}
         for key, value in data.items():
             value = self._restore_value(key, value)
-            restored_data[key] = value
+            if value is not self.missed:
+                restored_data[key] = value
+        self.stats.incr_keys(restored_data, 'hits')
+        self.stats.incr_keys((key for key in keys if key not in restored_data), 'misses')
         return restored_data
 
     def get_or_miss(self, key, miss=False):
@@ -76,21 +608,182 @@ class LazyCache(object):
                     cache.set(key, value)
                 return value
 
+        See get_or_set for a simpler version of the above example, which
+        also protects against cache stampedes.
+
         """
 
         return miss and self.missed or self.get(key, default=self.missed)
 
+    def get_or_set(self, key, producer, timeout=None, miss=False):
+        """
+        Returns the cached value, or calls producer() to create the value and
+        then adds it to the cache. Passing in True for the miss argument will
+        make it bypass the cache and always call producer().
+
+        This protects against cache stampedes. When the value is missing,
+        only one caller (across all processes sharing the cache) gets to run
+        producer() while holding a short-lived lock, which is made using the
+        cache's atomic "add" operation. Other callers wait for the value to
+        appear, for up to lock_wait seconds, before giving up and running
+        producer() themselves.
+
+        The value is also recomputed early, before it expires, based on how
+        long producer() took to run (this is the "XFetch" algorithm). The
+        chance of that happening increases as the expiry time approaches,
+        so usually only one caller will do it. Callers that find it already
+        being recomputed use the current value instead. Set recompute_beta
+        to 0 to disable this, or above 1 to recompute earlier.
+
+        When stale values are enabled (see the class docstring), a stale
+        value is returned straight away, and one caller gets to recreate it
+        in the background using the refresh pool.
+
+        Example usage:
+
+            def get_value(refresh_cache=False):
+                key = 'some.key.123'
+                return cache.get_or_set(key, generate_new_value, miss=refresh_cache)
+
+        """
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        # This thread might already hold the lock, if the producer ends up
+        # calling this method again with the same key. The value is being
+        # recreated, so just create it rather than returning the old value
+        # or waiting for itself.
+        held_locks = self._get_held_locks()
+        if key in held_locks:
+            return self._produce(key, producer, timeout)
+
+        value = miss and self.missed or self._get_prepared(key)
+        if value is not self.missed:
+            restored_value = self._restore_value(key, value)
+            if restored_value is self.missed:
+                value = self.missed
+            elif self._is_stale(value):
+                self.stats.incr_key(key, 'hits')
+                self.stats.incr_key(key, 'stale_hits')
+                self._refresh(key, producer, timeout)
+                return restored_value
+            elif not self._should_recompute(value):
+                self.stats.incr_key(key, 'hits')
+                return restored_value
+            else:
+                self.stats.incr_key(key, 'early_recomputes')
+        if value is self.missed:
+            self.stats.incr_key(key, 'misses')
+
+        lock_key = '%s:lock' % key
+        if self.cache.add(lock_key, True, self.lock_timeout):
+            held_locks.add(key)
+            try:
+                return self._produce(key, producer, timeout)
+            finally:
+                held_locks.discard(key)
+                self.cache.delete(lock_key)
+
+        if value is not self.missed:
+            # Another caller is already recomputing the value,
+            # so continue to use the current value.
+            return restored_value
+
+        # Wait for the other caller to add the value.
+        self.stats.incr_key(key, 'lock_waits')
+        give_up = time.time() + self.lock_wait
+        while time.time() < give_up:
+            time.sleep(self.lock_poll_interval)
+            value = self._get_prepared(key)
+            if value is not self.missed:
+                value = self._restore_value(key, value)
+                if value is not self.missed:
+                    return value
+            if not self.cache.get(lock_key):
+                # The lock was released without adding a value,
+                # so the other caller must have failed.
+                break
+
+        return self._produce(key, producer, timeout)
+
+    def _get_held_locks(self):
+        """Returns the keys that this thread is recreating values for."""
+        try:
+            return self._locks.held
+        except AttributeError:
+            self._locks.held = set()
+            return self._locks.held
+
+    def _refresh(self, key, producer, timeout):
+        """
+        Recreate a stale value in the background, unless another caller is
+        already doing it, or the refresh pool is too busy. In that case the
+        value will continue to be stale until it gets refreshed or expires.
+
+        """
+
+        lock_key = '%s:lock' % key
+        if not self.cache.add(lock_key, True, self.lock_timeout):
+            return
+
+        def refresh():
+            held_locks = self._get_held_locks()
+            held_locks.add(key)
+            try:
+                self._produce(key, producer, timeout)
+            except Exception:
+                logging.exception('Error refreshing stale cache key %r' % key)
+            finally:
+                held_locks.discard(key)
+                self.cache.delete(lock_key)
+
+        if self.refresh_pool.submit(refresh) is None:
+            self.cache.delete(lock_key)
+
+    def _produce(self, key, producer, timeout):
+        start = time.time()
+        value = producer()
+        delta = time.time() - start
+        self.stats.incr_key(key, 'produced')
+        self.stats.record_latency('produce', delta)
+        timeout = self._get_timeout(value, timeout)
+        prepared_value = self._prepare_value(key, value, timeout, delta=delta)
+        self._set_prepared(key, prepared_value, timeout)
+        return value
+
+    def _is_stale(self, value):
+        if isinstance(value, Envelope) and value.stale and self.refresh_pool is not None:
+            return time.time() >= value.stale
+        return False
+
+    def _should_recompute(self, value):
+        if isinstance(value, Envelope) and value.delta and self.recompute_beta:
+            # Use 1 - random() to avoid log(0).
+            early = value.delta * self.recompute_beta * -math.log(1.0 - random.random())
+            return time.time() + early >= value.expires
+        return False
+
     def set(self, key, value, timeout=None, **kwargs):
         if timeout is None:
             timeout = self.default_timeout
+        timeout = self._get_timeout(value, timeout)
         value = self._prepare_value(key, value, timeout)
-        return self.cache.set(key, value, timeout=timeout, **kwargs)
+        return self._set_prepared(key, value, timeout, **kwargs)
 
     def set_many(self, data, timeout=None, **kwargs):
         if timeout is None:
             timeout = self.default_timeout
+        # None values may need a different timeout,
+        # so group the values by their timeouts.
         prepared_data = {}
         for key, value in data.items():
-            value = self._prepare_value(key, value, timeout)
-            prepared_data[key] = value
-        self.cache.set_many(prepared_data, timeout=timeout, **kwargs)
+            value_timeout = self._get_timeout(value, timeout)
+            value = self._prepare_value(key, value, value_timeout)
+            prepared_data.setdefault(value_timeout, {})[key] = value
+        if self.hot_keys is not None:
+            self.hot_keys.invalidate(data, bump=False)
+        for value_timeout, timeout_data in prepared_data.items():
+            if self.local_cache is not None:
+                self.local_cache.set_many(timeout_data, value_timeout)
+            self._cache_set_many(timeout_data, value_timeout, **kwargs)
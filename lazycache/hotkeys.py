@@ -0,0 +1,155 @@
+import hashlib
+import random
+import struct
+import time
+
+from threading import Lock
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts for any number of keys, using a fixed amount of
+    memory. Each key is counted in one position of every row, and its count
+    is the smallest of those. Counts can be too high when keys share
+    positions, but they are never too low.
+
+    """
+
+    def __init__(self, width=1024, depth=4):
+        self.width = width
+        self.depth = depth
+        self.clear()
+
+    def _get_positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + row * second) % self.width for row in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """Add to the count of a key, and return its new count."""
+        estimate = None
+        for row, position in zip(self._rows, self._get_positions(key)):
+            row[position] += count
+            if estimate is None or row[position] < estimate:
+                estimate = row[position]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[position] for row, position in zip(self._rows, self._get_positions(key)))
+
+    def halve(self):
+        """Halve every count, so that old activity counts for less."""
+        for row in self._rows:
+            row[:] = [count // 2 for count in row]
+
+    def clear(self):
+        self._rows = [[0] * self.width for row in xrange(self.depth)]
+
+
+class HotKeys(object):
+    """
+    Finds the keys that are read most often, and pins their values in a
+    small local cache (see lazycache.local.LocalCache) so they can be read
+    without a request to the shared cache. The local cache timeout controls
+    how often pinned values are refreshed from the shared cache.
+
+    Reads are sampled at sample_rate and counted with a CountMinSketch.
+    A key becomes hot when it is estimated to have been read threshold times
+    in the current interval. Every interval seconds the counts are halved,
+    and keys that have dropped below the threshold are unpinned. Only the
+    max_keys hottest keys are kept.
+
+    Use keys() to see the hot keys and their estimated read counts.
+
+    """
+
+    def __init__(self, local_cache, threshold=1000, sample_rate=0.01, interval=60,
+                 max_keys=100, width=1024, depth=4):
+        self.local_cache = local_cache
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_keys = max_keys
+        self.sketch = CountMinSketch(width, depth)
+        self._hot = {}
+        self._decayed = time.time()
+        self._lock = Lock()
+
+    def _decay(self):
+        """Halve the counts, and forget keys that are no longer hot."""
+        self.sketch.halve()
+        for key, count in self._hot.items():
+            if count // 2 < self.threshold:
+                del self._hot[key]
+                self.local_cache.delete(key)
+            else:
+                self._hot[key] = count // 2
+        self._decayed = time.time()
+
+    def _promote(self, key, count):
+        """Mark a key as hot, replacing the coolest key if there are too many."""
+        self._hot[key] = count
+        if len(self._hot) > self.max_keys:
+            coolest_key = min(self._hot, key=self._hot.get)
+            del self._hot[coolest_key]
+            self.local_cache.delete(coolest_key)
+
+    def _sample(self, key):
+        """Count some of the reads of a key."""
+        if random.random() < self.sample_rate:
+            with self._lock:
+                if time.time() - self._decayed >= self.interval:
+                    self._decay()
+                count = int(self.sketch.add(key) / self.sample_rate)
+                if count >= self.threshold:
+                    self._promote(key, count)
+
+    def record(self, key, value):
+        """
+        Record that a key was read from the shared cache, and pin its value
+        if the key is hot.
+
+        """
+        self._sample(key)
+        if key in self._hot:
+            self.local_cache.set(key, value)
+
+    def get(self, key, default=None):
+        """Returns the pinned value of a hot key."""
+        if key in self._hot:
+            value = self.local_cache.get(key, self)
+            if value is not self:
+                self._sample(key)
+                return value
+        return default
+
+    def get_many(self, keys):
+        data = self.local_cache.get_many([key for key in keys if key in self._hot])
+        for key in data:
+            self._sample(key)
+        return data
+
+    def invalidate(self, keys, bump=True):
+        """
+        Remove the pinned values of keys. If bump is True, then the local
+        cache also bumps the generations of their groups, so other processes
+        discard their pinned values too, even if the keys are not hot here.
+
+        """
+        if bump:
+            self.local_cache.invalidate_many(keys)
+        else:
+            self.local_cache.delete_many(keys)
+
+    def keys(self):
+        """Returns the hot keys and their estimated read counts, hottest first."""
+        with self._lock:
+            return sorted(self._hot.items(), key=lambda item: item[1], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self.sketch.clear()
+            self._hot.clear()
+            self.local_cache.clear()
+            self._decayed = time.time()
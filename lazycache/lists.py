@@ -5,6 +5,20 @@ from threading import RLock
 from django.core.cache import cache
 
 
+def _unpack_first(method):
+    """Wrap a list method so that the list is fully unpacked first."""
+
+    def wrapper(self, *args, **kwargs):
+        if '_packed_windows' in self.__dict__:
+            with self._unpack_lock:
+                self._unpack_items()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
 class CachedList(list):
     """
     This list will, when pickled, cache each item individually and then only
@@ -15,9 +29,40 @@ class CachedList(list):
     This uses the set_many and get_many features of the cache backend
     to optimize cache access.
 
+    After unpickling, items are unpacked on demand in windows of
+    window_size items, so reading lst[0] or the first page of a long list
+    only fetches the items that are needed. Iterating fetches read_ahead
+    windows at a time. The length of the list is known without fetching
+    anything. Methods that change the list, or compare or search the whole
+    list, unpack all of the items first.
+
+    If an item cannot be found or rebuilt then it is removed from the list,
+    which changes the positions of the items after it. When that happens,
+    the whole list is unpacked at once so that positions only change once.
+
+    Missing items are rebuilt in chunks of rebuild_chunk_size identifiers,
+    to keep queries such as pk__in=identifiers to a reasonable size. Set
+    rebuild_pool to a lazycache.pool.WorkerPool to rebuild the chunks in
+    parallel. Its finalizer should close any database connections.
+
+    Caching the list replaces any cached values of its items. When the item
+    cache keys are shared with other code, set replace_cached_items to False
+    so that only missing items are added (with one get_many and one
+    set_many call), and a list that has been kept in memory does not
+    replace newer items. Rebuilt items are always cached, since they have
+    just been loaded.
+
+    Each unpickled list has its own lock for unpacking, so threads using
+    different lists do not wait for each other. Once a list has been
+    unpacked, reading it does not use the lock at all.
+
     """
 
-    _unpack_lock = RLock()
+    window_size = 100
+    read_ahead = 10
+    rebuild_chunk_size = 500
+    rebuild_pool = None
+    replace_cached_items = True
 
     def __init__(self, items, cache_backend=cache, cache_timeout=None):
         super(CachedList, self).__init__(items)
@@ -25,27 +70,58 @@ class CachedList(list):
         self.cache_timeout = cache_timeout
 
     def __iter__(self):
-        with self._unpack_lock:
-            self._unpack_items()
+        if '_packed_windows' in self.__dict__:
+            return self._iter_windows()
         return super(CachedList, self).__iter__()
 
     def __getitem__(self, i):
-        with self._unpack_lock:
-            self._unpack_items()
+        if '_packed_windows' in self.__dict__:
+            with self._unpack_lock:
+                if isinstance(i, slice):
+                    start, stop, step = i.indices(list.__len__(self))
+                    if step == 1:
+                        self._unpack_range(start, stop)
+                    else:
+                        self._unpack_windows(set(index // self.window_size for index in xrange(start, stop, step)))
+                else:
+                    if i < 0:
+                        i += list.__len__(self)
+                    self._unpack_range(i, i + 1)
         return super(CachedList, self).__getitem__(i)
 
     def __getslice__(self, i, j):
-        with self._unpack_lock:
-            if hasattr(self, '_unpack'):
-                # Avoid unpacking all items when slicing an unpacked list.
-                # Instead, make a new list and unpack that.
-                items = super(CachedList, self).__getslice__(i, j)
-                new_list = self.__class__(items)
-                new_list._unpack = True
-                new_list._unpack_items()
-                return new_list[:]
+        if '_packed_windows' in self.__dict__:
+            with self._unpack_lock:
+                self._unpack_range(i, j)
         return super(CachedList, self).__getslice__(i, j)
 
+    append = _unpack_first(list.append)
+    extend = _unpack_first(list.extend)
+    insert = _unpack_first(list.insert)
+    pop = _unpack_first(list.pop)
+    remove = _unpack_first(list.remove)
+    reverse = _unpack_first(list.reverse)
+    sort = _unpack_first(list.sort)
+    index = _unpack_first(list.index)
+    count = _unpack_first(list.count)
+    __setitem__ = _unpack_first(list.__setitem__)
+    __delitem__ = _unpack_first(list.__delitem__)
+    __setslice__ = _unpack_first(list.__setslice__)
+    __delslice__ = _unpack_first(list.__delslice__)
+    __iadd__ = _unpack_first(list.__iadd__)
+    __imul__ = _unpack_first(list.__imul__)
+    __add__ = _unpack_first(list.__add__)
+    __mul__ = _unpack_first(list.__mul__)
+    __rmul__ = _unpack_first(list.__rmul__)
+    __contains__ = _unpack_first(list.__contains__)
+    __reversed__ = _unpack_first(list.__reversed__)
+    __eq__ = _unpack_first(list.__eq__)
+    __ne__ = _unpack_first(list.__ne__)
+    __lt__ = _unpack_first(list.__lt__)
+    __le__ = _unpack_first(list.__le__)
+    __gt__ = _unpack_first(list.__gt__)
+    __ge__ = _unpack_first(list.__ge__)
+
     def __reduce__(self):
         """
         When pickling instances of this class, pack the items so that only
@@ -58,41 +134,66 @@ class CachedList(list):
             self.__class__,
             self._pack_items(),
         )
+        return (_unpickle_cached_list, init_args, self._init_kwargs())
+
+    def _init_kwargs(self):
+        """
+        Returns the attributes to restore when this list is unpickled.
+        Subclasses can extend this to keep their own attributes.
+
+        """
         if self.cache_timeout:
-            init_kwargs = {'cache_timeout': self.cache_timeout}
-        else:
-            init_kwargs = {}
-        return (_unpickle_cached_list, init_args, init_kwargs)
+            return {'cache_timeout': self.cache_timeout}
+        return {}
 
-    def _pack_items(self):
+    def _cache_items(self, items, replace=True):
         """
-        Reduce the items in this list to identifiers that can be used to
-        recreate them from scratch. This adds each item to the cache too.
+        Add items to the cache, and return their identifiers in the same order.
+        If replace is False, then items that are already cached are skipped.
 
         """
-        identifiers = tuple(self.identify_items(self))
+        identifiers = tuple(self.identify_items(items))
         cache_keys = self.make_cache_keys(identifiers)
-        cache_items = dict(izip(cache_keys, self))
-        self.cache.set_many(cache_items, self.cache_timeout)
+        cache_items = dict(izip(cache_keys, items))
+        if not replace:
+            for cache_key in self.cache_backend.get_many(cache_items.keys()):
+                del cache_items[cache_key]
+        if cache_items:
+            self.cache_backend.set_many(cache_items, self.cache_timeout)
         return identifiers
 
-    def _unpack_items(self):
+    def _pack_items(self):
         """
-        Update the values of this list to the items which the identifiers
-        represent. They are either found in the cache or rebuilt and added
-        to the cache.
+        Reduce the items in this list to identifiers that can be used to
+        recreate them from scratch. This adds each item to the cache too,
+        unless replace_cached_items is False and it is already cached.
+        Items that have not been unpacked yet are already identifiers.
 
         """
 
-        # Prevent the unpack operation from occurring more than once.
-        if hasattr(self, '_unpack'):
-            delattr(self, '_unpack')
-        else:
-            return
+        replace = self.replace_cached_items
+        packed_windows = self.__dict__.get('_packed_windows')
+        if not packed_windows:
+            return self._cache_items(list(super(CachedList, self).__iter__()), replace)
+
+        identifiers = list(super(CachedList, self).__iter__())
+        positions = [
+            position for position in xrange(len(identifiers))
+            if position // self.window_size not in packed_windows
+        ]
+        if positions:
+            unpacked_identifiers = self._cache_items([identifiers[position] for position in positions], replace)
+            for position, identifier in izip(positions, unpacked_identifiers):
+                identifiers[position] = identifier
+        return tuple(identifiers)
+
+    def _get_items(self, identifiers):
+        """
+        Returns a dictionary of identifiers and the items that they
+        represent. They are either found in the cache or rebuilt and added
+        to the cache. Items that cannot be rebuilt are left out.
 
-        # The list contains identifiers that will be unpacked into real items.
-        # Copy them so they won't be lost when the list values are altered.
-        identifiers = self[:]
+        """
 
         cache_keys = dict(izip(identifiers, self.make_cache_keys(identifiers)))
         cached_items = self.cache_backend.get_many(cache_keys.values())
@@ -110,22 +211,143 @@ class CachedList(list):
 
         if missed:
 
-            # Rebuild the missing items using their identifiers and
-            # replace the contents of this list with those new items.
-            self[:] = self.rebuild_items(missed)
+            # Report the rebuilt items if the cache backend keeps stats.
+            stats = getattr(self.cache_backend, 'stats', None)
+            if stats is not None:
+                stats.incr(self.__class__.__name__, 'rebuilds', len(missed))
 
-            # Use the pack_items method to add them to the cache and also
-            # get back their identifiers. Finally, put the new items into
-            # the items dict to be returned at the end.
-            found_identifiers = self._pack_items()
-            items.update(izip(found_identifiers, self))
+            items.update(self._rebuild_items(missed))
+
+        return items
+
+    def _rebuild_chunk(self, identifiers):
+        """
+        Rebuild the items for some identifiers, add them to the cache and
+        return them as a dictionary.
+
+        """
+        rebuilt_items = list(self.rebuild_items(identifiers))
+        if not rebuilt_items:
+            return {}
+        return dict(izip(self._cache_items(rebuilt_items), rebuilt_items))
+
+    def _rebuild_items(self, identifiers):
+        """
+        Rebuild the missing items using their identifiers, in chunks of
+        rebuild_chunk_size. Each chunk is added to the cache as soon as it
+        has been rebuilt, so the work is not lost if a later chunk fails.
+        If there is a rebuild_pool, then the chunks are rebuilt in parallel.
+
+        """
+
+        size = self.rebuild_chunk_size or len(identifiers)
+        chunks = [identifiers[index:index + size] for index in xrange(0, len(identifiers), size)]
+
+        items = {}
+        if self.rebuild_pool and len(chunks) > 1:
+            results = [self.rebuild_pool.submit(self._rebuild_chunk, chunk) for chunk in chunks]
+            for chunk, result in izip(chunks, results):
+                if result is None:
+                    # The pool is busy, so do this chunk here instead.
+                    items.update(self._rebuild_chunk(chunk))
+                else:
+                    items.update(result.get())
+        else:
+            for chunk in chunks:
+                items.update(self._rebuild_chunk(chunk))
+        return items
+
+    def _unpack_range(self, start, stop):
+        """Unpack the windows containing the items from start to stop."""
+        stop = min(stop, list.__len__(self))
+        if start < stop:
+            self._unpack_windows(xrange(max(start, 0) // self.window_size, (stop - 1) // self.window_size + 1))
+
+    def _unpack_windows(self, windows):
+        """
+        Update the values of the given windows of this list to the items
+        which their identifiers represent.
+
+        """
+
+        packed_windows = self.__dict__.get('_packed_windows')
+        if not packed_windows:
+            return
+
+        positions = []
+        for window in sorted(packed_windows.intersection(windows)):
+            start = window * self.window_size
+            positions.extend(xrange(start, min(start + self.window_size, list.__len__(self))))
+        if not positions:
+            return
+
+        identifiers = [list.__getitem__(self, position) for position in positions]
+        items = self._get_items(identifiers)
+
+        missed = [identifier for identifier in identifiers if identifier not in items]
+        if missed:
+            # Some items will be removed, so unpack everything now.
+            self._unpack_items(items, missed)
+            return
+
+        for position, identifier in izip(positions, identifiers):
+            list.__setitem__(self, position, items[identifier])
+        packed_windows.difference_update(windows)
+        if not packed_windows:
+            del self._packed_windows
+
+    def _unpack_items(self, items=None, missed=()):
+        """
+        Update the values of this list to the items which the identifiers
+        represent. They are either found in the cache or rebuilt and added
+        to the cache. Any items that were already found can be provided
+        as a dictionary, and the identifiers of any items that could not
+        be found or rebuilt as a list, to avoid fetching them again.
+
+        """
+
+        packed_windows = self.__dict__.get('_packed_windows')
+        if not packed_windows:
+            return
 
-        # Replace the value of this list with the final result.
-        del self[:]
-        for identifier in identifiers:
-            item = items.get(identifier)
-            if item is not None:
-                self.append(item)
+        values = list(super(CachedList, self).__iter__())
+        positions = [
+            position for position in xrange(len(values))
+            if position // self.window_size in packed_windows
+        ]
+
+        items = dict(items or ())
+        missed = set(missed)
+        missing = [
+            values[position] for position in positions
+            if values[position] not in items and values[position] not in missed
+        ]
+        if missing:
+            items.update(self._get_items(missing))
+
+        # Replace the identifiers with their items, and then replace the
+        # value of this list with the final result, without the items
+        # that could not be found.
+        for position in positions:
+            values[position] = items.get(values[position])
+        list.__setslice__(self, 0, list.__len__(self), [item for item in values if item is not None])
+
+        # Other threads read the list without the lock when this attribute
+        # is missing, so only remove it once the items are in place.
+        del self._packed_windows
+
+    def _iter_windows(self):
+        """Iterate through the list, unpacking it as it goes."""
+        index = 0
+        while index < list.__len__(self):
+            packed_windows = self.__dict__.get('_packed_windows')
+            window = index // self.window_size
+            if packed_windows and window in packed_windows:
+                with self._unpack_lock:
+                    self._unpack_windows(xrange(window, window + self.read_ahead))
+                continue
+            yield list.__getitem__(self, index)
+            index += 1
 
     def cache(self, key, timeout=None):
         """
@@ -140,8 +362,14 @@ class CachedList(list):
         """
         original_cache_timeout = self.cache_timeout
         self.cache_timeout = timeout
-        self.cache_backend.set(key, self, timeout)
-        self.cache_timeout = original_cache_timeout
+        try:
+            # Pack the items before calling the cache backend, because some
+            # backends hold a lock while pickling, and pickling this list
+            # would add the items to the same cache.
+            packed = _unpickle_cached_list(self.__class__, self._pack_items(), **self._init_kwargs())
+        finally:
+            self.cache_timeout = original_cache_timeout
+        self.cache_backend.set(key, packed, timeout)
 
     def identify_items(self, items):
         """
@@ -182,5 +410,8 @@ def _unpickle_cached_list(cls, *args, **kwargs):
 
     """
     new_list = cls(*args, **kwargs)
-    new_list._unpack = True
+    window_count = (list.__len__(new_list) + new_list.window_size - 1) // new_list.window_size
+    if window_count:
+        new_list._unpack_lock = RLock()
+        new_list._packed_windows = set(xrange(window_count))
     return new_list
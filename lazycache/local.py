@@ -0,0 +1,192 @@
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class Generations(object):
+    """
+    Generation numbers for groups of cache keys. They are stored in a shared
+    cache so that every process sees the same numbers. Bumping the generation
+    of a group marks everything cached against the old generation as being
+    out of date.
+
+    Reading a generation from the shared cache would add a round trip to
+    every lookup, so values are remembered in this process for "interval"
+    seconds. Changes made by other processes become visible after at most
+    that long. Changes made by this process are visible immediately.
+
+    """
+
+    def __init__(self, cache, namespace='Generation', interval=1, timeout=60 * 60 * 24 * 30):
+        self.cache = cache
+        self.namespace = namespace
+        self.interval = interval
+        self.timeout = timeout
+        self._local = {}
+
+    def key(self, group):
+        return '%s:%s' % (self.namespace, group)
+
+    def get(self, group):
+        now = time.time()
+        try:
+            value, checked = self._local[group]
+            if now - checked < self.interval:
+                return value
+        except KeyError:
+            pass
+
+        key = self.key(group)
+        value = self.cache.get(key)
+        if value is None:
+            # Start new counters from the current time rather than 1, so
+            # that a counter that was evicted from the cache will not start
+            # reusing generation numbers that were used before.
+            value = int(now)
+            if not self.cache.add(key, value, self.timeout):
+                value = self.cache.get(key) or value
+
+        self._local[group] = (value, now)
+        return value
+
+    def bump(self, group):
+        """Increment the generation of a group, returning the new value."""
+        key = self.key(group)
+        try:
+            value = self.cache.incr(key)
+        except ValueError:
+            value = int(time.time())
+            self.cache.set(key, value, self.timeout)
+        self._local[group] = (value, time.time())
+        return value
+
+    def clear(self):
+        """Forget the generation numbers remembered by this process."""
+        self._local.clear()
+
+
+class LocalCache(object):
+    """
+    A small, thread-safe LRU cache that lives inside the current process,
+    for use in front of a shared cache. It is bounded by the number of
+    entries and by their total size, and entries only live for a short time.
+
+    Values are stored pickled, so every read returns a new copy of the value,
+    just like reading from a shared cache would. This avoids requests sharing
+    (and possibly changing) the same model instances.
+
+    If a Generations object and a get_group function are provided, then each
+    entry remembers the generation of its group when it was added, and is
+    discarded if that generation has changed. This allows writes made by
+    other processes to become visible without waiting for the timeout.
+
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=1024 * 1024 * 10, timeout=5, generations=None, get_group=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.generations = generations
+        self.get_group = get_group
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return self.get(key, default=self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_generation(self, key):
+        if self.generations is not None and self.get_group is not None:
+            group = self.get_group(key)
+            if group:
+                return self.generations.get(group)
+        return None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, generation, data = entry
+            if expires < time.time():
+                self._bytes -= len(data)
+                return default
+            # Put it back at the end, marking it as the most recently used.
+            self._entries[key] = entry
+        if generation != self._get_generation(key):
+            with self._lock:
+                self._remove(key)
+            return default
+        return pickle.loads(data)
+
+    def get_many(self, keys):
+        result = {}
+        for key in keys:
+            value = self.get(key, default=self)
+            if value is not self:
+                result[key] = value
+        return result
+
+    def set(self, key, value, timeout=None):
+        if not timeout or timeout > self.timeout:
+            timeout = self.timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        generation = self._get_generation(key)
+        with self._lock:
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + timeout, generation, data)
+            self._bytes += len(data)
+            # Discard the least recently used entries until it fits.
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def invalidate(self, key):
+        """
+        Remove a key from this process, and bump the generation of its group
+        so that other processes will discard their copies too.
+
+        """
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        self.delete_many(keys)
+        if self.generations is not None and self.get_group is not None:
+            groups = set(self.get_group(key) for key in keys)
+            for group in groups:
+                if group:
+                    self.generations.bump(group)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,63 @@
+import logging
+import os
+
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+
+class WorkerPool(object):
+    """
+    A pool of threads for running functions in the background.
+
+    The threads are started when they are first needed, and started again
+    if the process has been forked since then. The number of functions
+    waiting to run can be limited with max_pending; when the limit has been
+    reached, submit will return None instead of accepting more work.
+
+    If a finalizer function is provided, it is called by the worker thread
+    after each function has finished. This can be used to close database
+    connections that the function may have opened.
+
+    """
+
+    def __init__(self, workers=4, max_pending=None, finalizer=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.finalizer = finalizer
+        self._lock = Lock()
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.workers)
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._pool
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            if self.finalizer:
+                try:
+                    self.finalizer()
+                except Exception:
+                    logging.exception('Error in worker pool finalizer')
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in a worker thread. Returns an AsyncResult,
+        or None if there are already max_pending functions waiting to run.
+
+        """
+        pool = self._get_pool()
+        with self._lock:
+            if self.max_pending is not None and self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+        return pool.apply_async(self._run, (func, args, kwargs))
@@ -0,0 +1,172 @@
+import hashlib
+import struct
+
+from bisect import bisect
+from threading import Lock
+
+from django.core.cache import get_cache
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to nodes. Each node is placed at many points
+    on a ring, and a key belongs to the node at the next point after the
+    hash of the key. Adding a node to a ring of N nodes only moves about
+    1/(N+1) of the keys, all of them to the new node.
+
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (self.hash('%s-%d' % (node, index)), node)
+            for node in nodes
+            for index in xrange(replicas)
+        )
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+    def get_node(self, key):
+        index = bisect(self._hashes, self.hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._nodes[index]
+
+
+class ShardedCache(object):
+    """
+    Spreads keys across several Django caches, which are given as the
+    aliases in the CACHES setting. Keys are assigned to caches using
+    consistent hashing, so adding a cache only moves a small part of the
+    keys.
+
+    The namespace of a key is the part before the first colon. Namespaces
+    can be routed to their own list of aliases, such as keeping lookups in
+    a separate cluster from the rows that they refer to.
+
+    The get_many, set_many and delete_many methods split the keys by cache.
+    If a pool (see lazycache.pool.WorkerPool) is provided, the caches are
+    called in parallel, with the calling thread doing one of them. Cache
+    backends must then be safe to use from several threads.
+
+    Usage:
+        LazyCache(ShardedCache(
+            aliases=['rows1', 'rows2', 'rows3'],
+            routes={'ModelCacheLookup': ['lookups']},
+            pool=WorkerPool(workers=3),
+        ))
+
+    """
+
+    def __init__(self, aliases, routes=None, pool=None, replicas=100):
+        self.aliases = list(aliases)
+        self.routes = dict(routes or {})
+        self.pool = pool
+        self.replicas = replicas
+        self._lock = Lock()
+        self._caches = {}
+        self._rings = {}
+
+    def get_ring(self, namespace):
+        try:
+            return self._rings[namespace]
+        except KeyError:
+            aliases = self.routes.get(namespace, self.aliases)
+            return self._rings.setdefault(namespace, HashRing(aliases, self.replicas))
+
+    def get_alias(self, key):
+        """Returns the alias of the cache that a key belongs to."""
+        namespace = key.split(':', 1)[0]
+        if namespace not in self.routes:
+            namespace = None
+        return self.get_ring(namespace).get_node(key)
+
+    def get_cache(self, alias):
+        try:
+            return self._caches[alias]
+        except KeyError:
+            with self._lock:
+                if alias not in self._caches:
+                    self._caches[alias] = get_cache(alias)
+                return self._caches[alias]
+
+    def get_shard(self, key):
+        return self.get_cache(self.get_alias(key))
+
+    def _split(self, keys):
+        """Group keys by the alias of their cache."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_alias(key), []).append(key)
+        return groups
+
+    def _map(self, func, groups):
+        """
+        Call func(cache, group) for every alias and group, in parallel if
+        there is a pool, and return the results in a list.
+
+        """
+
+        items = [(self.get_cache(alias), group) for alias, group in groups.items()]
+        if not self.pool or len(items) < 2:
+            return [func(cache, group) for cache, group in items]
+
+        pending = [self.pool.submit(func, cache, group) for cache, group in items[1:]]
+        results = [func(*items[0])]
+        for (cache, group), result in zip(items[1:], pending):
+            if result is None:
+                # The pool is busy, so do this one here instead.
+                results.append(func(cache, group))
+            else:
+                results.append(result.get())
+        return results
+
+    def add(self, key, value, timeout=None, **kwargs):
+        return self.get_shard(key).add(key, value, timeout=timeout, **kwargs)
+
+    def get(self, key, default=None, **kwargs):
+        return self.get_shard(key).get(key, default=default, **kwargs)
+
+    def set(self, key, value, timeout=None, **kwargs):
+        return self.get_shard(key).set(key, value, timeout=timeout, **kwargs)
+
+    def delete(self, key, **kwargs):
+        return self.get_shard(key).delete(key, **kwargs)
+
+    def incr(self, key, delta=1, **kwargs):
+        return self.get_shard(key).incr(key, delta, **kwargs)
+
+    def decr(self, key, delta=1, **kwargs):
+        return self.get_shard(key).decr(key, delta, **kwargs)
+
+    def has_key(self, key, **kwargs):
+        return self.get_shard(key).has_key(key, **kwargs)
+
+    def get_many(self, keys, **kwargs):
+        data = {}
+        for result in self._map(lambda cache, group: cache.get_many(group, **kwargs), self._split(keys)):
+            data.update(result)
+        return data
+
+    def set_many(self, data, timeout=None, **kwargs):
+        groups = self._split(data)
+
+        def set_many(cache, group):
+            cache.set_many(dict((key, data[key]) for key in group), timeout=timeout, **kwargs)
+
+        self._map(set_many, groups)
+
+    def delete_many(self, keys, **kwargs):
+        self._map(lambda cache, group: cache.delete_many(group, **kwargs), self._split(keys))
+
+    def clear(self):
+        aliases = set(self.aliases)
+        for route_aliases in self.routes.values():
+            aliases.update(route_aliases)
+        for alias in aliases:
+            self.get_cache(alias).clear()
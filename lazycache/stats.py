@@ -0,0 +1,128 @@
+import time
+
+from contextlib import contextmanager
+from threading import Lock
+
+
+def get_namespace(key):
+    """
+    Returns the namespace of a cache key, which is the part before the first
+    colon, e.g. "ModelCache" for "ModelCache:1:auth.user.123".
+
+    """
+    if ':' in key:
+        return key.split(':', 1)[0]
+    return 'default'
+
+
+class Histogram(object):
+    """Counts values into buckets, where each bucket has an upper bound."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        buckets = []
+        for bound, count in zip(self.bounds + (None,), self.counts):
+            buckets.append((bound is None and '+Inf' or bound, count))
+        return {
+            'buckets': buckets,
+            'count': self.count,
+            'total': self.total,
+        }
+
+
+class CacheStats(object):
+    """
+    Thread-safe counters and histograms that describe how a cache is used.
+
+    Counters are grouped by namespace (see get_namespace), e.g. the number of
+    hits and misses for "ModelCache" keys. Latency histograms (in seconds)
+    are kept for each cache backend operation, e.g. "get_many". If
+    record_sizes is enabled, then a histogram of value sizes (in bytes)
+    is also kept, although this requires pickling values an extra time
+    unless they are already being pickled for compression.
+
+    Use snapshot() to get all of the data as a dictionary,
+    and reset() to start again from zero.
+
+    """
+
+    latency_bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+    size_bounds = (128, 1024, 1024 * 8, 1024 * 64, 1024 * 256, 1024 * 1024)
+
+    def __init__(self, enabled=True, record_sizes=False):
+        self.enabled = enabled
+        self.record_sizes = record_sizes
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._latency = {}
+            self._sizes = Histogram(self.size_bounds)
+            self._started = time.time()
+
+    def incr(self, namespace, name, count=1):
+        if self.enabled and count:
+            with self._lock:
+                counters = self._counters.setdefault(namespace, {})
+                counters[name] = counters.get(name, 0) + count
+
+    def incr_key(self, key, name, count=1):
+        self.incr(get_namespace(key), name, count)
+
+    def incr_keys(self, keys, name):
+        """Increment a counter once for every key, grouped by namespace."""
+        if self.enabled:
+            counts = {}
+            for key in keys:
+                namespace = get_namespace(key)
+                counts[namespace] = counts.get(namespace, 0) + 1
+            for namespace, count in counts.items():
+                self.incr(namespace, name, count)
+
+    def record_latency(self, operation, seconds):
+        if self.enabled:
+            with self._lock:
+                try:
+                    histogram = self._latency[operation]
+                except KeyError:
+                    histogram = self._latency[operation] = Histogram(self.latency_bounds)
+                histogram.add(seconds)
+
+    def record_size(self, size):
+        if self.enabled:
+            with self._lock:
+                self._sizes.add(size)
+
+    @contextmanager
+    def timer(self, operation):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_latency(operation, time.time() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict((namespace, dict(counters)) for (namespace, counters) in self._counters.items()),
+                'latency': dict((operation, histogram.snapshot()) for (operation, histogram) in self._latency.items()),
+                'sizes': self._sizes.snapshot(),
+                'seconds': time.time() - self._started,
+            }
@@ -1,10 +1,19 @@
 import pickle
+import threading
+import time
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
 
-from lazycache.lists import CachedList
+from lazycache import Chunked, Compressed, LazyCache
+from lazycache.hotkeys import CountMinSketch, HotKeys
+from lazycache.lists import CachedList, _unpickle_cached_list
+from lazycache.local import Generations, LocalCache
+from lazycache.pool import WorkerPool
+from lazycache.sharded import HashRing, ShardedCache
+from lazycache.stats import CacheStats
 
 
 class TestUserCachedList(CachedList):
@@ -21,6 +30,56 @@ class TestUserCachedList(CachedList):
         return User.objects.filter(pk__in=user_pks)
 
 
+class WindowedUserCachedList(TestUserCachedList):
+    window_size = 5
+    read_ahead = 2
+
+
+class ChunkedUserCachedList(TestUserCachedList):
+    rebuild_chunk_size = 5
+
+    def rebuild_items(self, user_pks):
+        self.chunks.append(len(user_pks))
+        return super(ChunkedUserCachedList, self).rebuild_items(user_pks)
+
+
+class SharedUserCachedList(TestUserCachedList):
+    replace_cached_items = False
+
+
+class RecordingCache(object):
+    """
+    Records the number of keys requested by each get_many call, and the
+    number of keys used by each call in the order that they were made.
+
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.calls = []
+
+    def add(self, key, *args, **kwargs):
+        self.calls.append(('add', 1))
+        return cache.add(key, *args, **kwargs)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        self.requests.append(len(keys))
+        self.calls.append(('get_many', len(keys)))
+        return cache.get_many(keys)
+
+    def set_many(self, data, *args, **kwargs):
+        self.calls.append(('set_many', len(data)))
+        return cache.set_many(data, *args, **kwargs)
+
+
+class LocMemShardedCache(ShardedCache):
+    """A ShardedCache which uses a new LocMemCache for each alias."""
+
+    def get_cache(self, alias):
+        return self._caches.setdefault(alias, LocMemCache('ShardedCacheTests:%s' % alias, {}))
+
+
 class CachedListTests(TestCase):
 
     def test_cached_list(self):
@@ -53,3 +112,491 @@ class CachedListTests(TestCase):
         cache.delete_many(item_cache_keys)
         user_cache = cache.get(cache_key)
         self.assertEqual([user.pk for user in users], [user.pk for user in user_cache])
+
+    def test_windows(self):
+
+        users = list(User.objects.order_by('pk')[:12])
+        user_pks = [user.pk for user in users]
+        pickled = pickle.dumps(WindowedUserCachedList(users))
+
+        # Only the windows containing the requested items are fetched.
+        user_cache = pickle.loads(pickled)
+        user_cache.cache_backend = recorder = RecordingCache()
+        self.assertEqual(len(user_cache), 12)
+        self.assertEqual(recorder.requests, [])
+        self.assertEqual(user_cache[0].pk, user_pks[0])
+        self.assertEqual(user_cache[-1].pk, user_pks[-1])
+        self.assertEqual([user.pk for user in user_cache[1:3]], user_pks[1:3])
+        self.assertEqual(recorder.requests, [5, 2])
+        self.assertEqual([user.pk for user in user_cache], user_pks)
+        self.assertEqual(recorder.requests, [5, 2, 5])
+
+        # A partly unpacked list can be pickled again.
+        user_cache = pickle.loads(pickled)
+        user_cache[7]
+        user_cache = pickle.loads(pickle.dumps(user_cache))
+        self.assertEqual([user.pk for user in user_cache], user_pks)
+
+        # Changing the list unpacks all of it first.
+        user_cache = pickle.loads(pickled)
+        user_cache.cache_backend = recorder = RecordingCache()
+        user_cache.append(users[0])
+        self.assertEqual(recorder.requests, [12])
+        self.assertEqual([user.pk for user in user_cache], user_pks + user_pks[:1])
+
+        # Items that no longer exist are removed, which unpacks everything.
+        missing_pk = User.objects.order_by('-pk')[0].pk + 1
+        user_cache = _unpickle_cached_list(WindowedUserCachedList, user_pks[:2] + [missing_pk] + user_pks[2:])
+        user_cache.cache_backend = recorder = RecordingCache()
+        self.assertEqual(user_cache[0].pk, user_pks[0])
+        self.assertEqual(recorder.requests, [5, 8])
+        self.assertEqual(len(user_cache), 12)
+        self.assertEqual([user.pk for user in user_cache], user_pks)
+
+    def test_chunked_rebuild(self):
+
+        users = list(User.objects.order_by('pk')[:12])
+        user_pks = [user.pk for user in users]
+        item_cache_keys = list(TestUserCachedList([]).make_cache_keys(user_pks))
+
+        for rebuild_pool in (None, WorkerPool(workers=2)):
+            cache.delete_many(item_cache_keys)
+            user_cache = _unpickle_cached_list(ChunkedUserCachedList, user_pks)
+            user_cache.rebuild_pool = rebuild_pool
+            user_cache.chunks = []
+            self.assertEqual([user.pk for user in user_cache], user_pks)
+            self.assertEqual(sorted(user_cache.chunks), [2, 5, 5])
+            self.assertEqual(len(cache.get_many(item_cache_keys)), 12)
+
+    def test_shared_items(self):
+
+        users = list(User.objects.order_by('pk')[:3])
+        user_pks = [user.pk for user in users]
+        item_cache_keys = list(TestUserCachedList([]).make_cache_keys(user_pks))
+
+        # Rebuilt items are cached with one set_many call for the chunk.
+        cache.delete_many(item_cache_keys)
+        user_cache = _unpickle_cached_list(SharedUserCachedList, user_pks)
+        user_cache.cache_backend = recorder = RecordingCache()
+        self.assertEqual([user.pk for user in user_cache], user_pks)
+        self.assertEqual(recorder.calls, [('get_many', 3), ('set_many', 3)])
+
+        # Packing the list only adds the items that are not cached,
+        # with one get_many call and one set_many call.
+        cache.delete(item_cache_keys[0])
+        recorder.calls = []
+        pickle.dumps(user_cache)
+        self.assertEqual(recorder.calls, [('get_many', 3), ('set_many', 1)])
+
+        recorder.calls = []
+        pickle.dumps(user_cache)
+        self.assertEqual(recorder.calls, [('get_many', 3)])
+
+    def test_threads(self):
+
+        users = list(User.objects.order_by('pk')[:12])
+        user_pks = [user.pk for user in users]
+        user_cache = pickle.loads(pickle.dumps(WindowedUserCachedList(users)))
+
+        # Threads reading the same list while it is being unpacked
+        # must only ever see the unpacked items.
+        results = []
+
+        def read():
+            results.append([user.pk for user in user_cache])
+
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [user_pks] * 8)
+
+
+class LocalCacheTests(TestCase):
+
+    def test_limits(self):
+
+        local_cache = LocalCache(max_entries=2)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        self.assertEqual(local_cache.get('a'), 1)
+
+        # Adding a third entry should remove the least recently used one.
+        local_cache.set('c', 3)
+        self.assertEqual(len(local_cache), 2)
+        self.assertEqual(local_cache.get('b'), None)
+        self.assertEqual(local_cache.get('a'), 1)
+
+        # Values that are too big for the cache are not added at all.
+        local_cache = LocalCache(max_bytes=100)
+        local_cache.set('big', 'x' * 1000)
+        self.assertFalse('big' in local_cache)
+
+        # Expired entries are not returned.
+        local_cache = LocalCache(timeout=-1)
+        local_cache.set('a', 1)
+        self.assertFalse('a' in local_cache)
+
+    def test_copies(self):
+        local_cache = LocalCache()
+        value = {'a': 1}
+        local_cache.set('key', value)
+        value['a'] = 2
+        self.assertEqual(local_cache.get('key'), {'a': 1})
+
+    def test_generations(self):
+
+        generations = Generations(cache, namespace='LocalCacheTests', interval=60)
+        get_group = lambda key: key.split('.')[0]
+
+        # Two caches act like two separate processes.
+        local_cache = LocalCache(generations=generations, get_group=get_group)
+        other_generations = Generations(cache, namespace='LocalCacheTests', interval=0)
+        other_local_cache = LocalCache(generations=other_generations, get_group=get_group)
+
+        local_cache.set('group.1', 'one')
+        other_local_cache.set('group.1', 'one')
+        other_local_cache.set('other.1', 'one')
+
+        # Invalidating a key bumps the generation of its group, so the other
+        # process discards its values from that group but keeps the others.
+        local_cache.invalidate('group.1')
+        self.assertFalse('group.1' in local_cache)
+        self.assertFalse('group.1' in other_local_cache)
+        self.assertTrue('other.1' in other_local_cache)
+
+    def test_lazy_cache(self):
+
+        lazy_cache = LazyCache(cache, local_cache=LocalCache())
+        lazy_cache.set('LocalCacheTests:a', None)
+        lazy_cache.set_many({'LocalCacheTests:b': 2})
+
+        # Values are served from the local cache, even if they have been
+        # removed from the main cache behind its back.
+        cache.delete_many(['LocalCacheTests:a', 'LocalCacheTests:b'])
+        self.assertEqual(lazy_cache['LocalCacheTests:a'], None)
+        self.assertEqual(lazy_cache.get_many(['LocalCacheTests:a', 'LocalCacheTests:b']), {
+            'LocalCacheTests:a': None,
+            'LocalCacheTests:b': 2,
+        })
+
+        # Deleting through the wrapper removes them from both.
+        del lazy_cache['LocalCacheTests:a']
+        self.assertRaises(KeyError, lambda: lazy_cache['LocalCacheTests:a'])
+
+
+class GetOrSetTests(TestCase):
+
+    def test_get_or_set(self):
+
+        lazy_cache = LazyCache(cache)
+        key = 'GetOrSetTests:value'
+        lazy_cache.delete(key)
+
+        calls = []
+
+        def producer():
+            calls.append(True)
+            return None
+
+        # None values are cached too, so the producer only runs once.
+        self.assertEqual(lazy_cache.get_or_set(key, producer), None)
+        self.assertEqual(lazy_cache.get_or_set(key, producer), None)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(lazy_cache[key], None)
+
+        # Forcing a miss runs it again.
+        lazy_cache.get_or_set(key, producer, miss=True)
+        self.assertEqual(len(calls), 2)
+
+    def test_stampede_lock(self):
+
+        lazy_cache = LazyCache(cache)
+        lazy_cache.lock_wait = 0.2
+        key = 'GetOrSetTests:locked'
+        lazy_cache.delete(key)
+
+        # Pretend that another process is creating the value. If it never
+        # appears, the value gets created here after waiting.
+        cache.add('%s:lock' % key, True)
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'created'), 'created')
+
+        # If the value is being recomputed early, then the current value
+        # is used rather than waiting for the new one.
+        cache.delete('%s:lock' % key)
+
+        def first():
+            time.sleep(0.01)
+            return 'first'
+
+        lazy_cache.get_or_set(key, first, timeout=60, miss=True)
+        cache.add('%s:lock' % key, True)
+        lazy_cache.recompute_beta = 1000000
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'second'), 'first')
+
+        # When the lock is released, the value is recomputed early.
+        cache.delete('%s:lock' % key)
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'second'), 'second')
+
+    def test_stale_values(self):
+
+        pool = WorkerPool(workers=1)
+        lazy_cache = LazyCache(cache, stale_timeout=0.1, refresh_pool=pool)
+        key = 'GetOrSetTests:stale'
+        lazy_cache.delete(key)
+
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'old', timeout=60), 'old')
+        time.sleep(0.15)
+
+        # The stale value is returned while the new one is created
+        # in the background.
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'new', timeout=60), 'old')
+        for attempt in range(50):
+            if lazy_cache.get(key) == 'new':
+                break
+            time.sleep(0.01)
+        self.assertEqual(lazy_cache.get_or_set(key, lambda: 'newer', timeout=60), 'new')
+
+
+class AsyncTests(TestCase):
+
+    def test_async_methods(self):
+
+        lazy_cache = LazyCache(cache)
+
+        results = [
+            lazy_cache.aset('AsyncTests:a', 1),
+            lazy_cache.aset_many({'AsyncTests:b': None}),
+        ]
+        for result in results:
+            result.get()
+
+        self.assertEqual(lazy_cache.aget('AsyncTests:a').get(), 1)
+        self.assertEqual(lazy_cache.aget('AsyncTests:missing', 2).get(), 2)
+        self.assertTrue(lazy_cache.aget_or_miss('AsyncTests:missing').get() is lazy_cache.missed)
+        self.assertEqual(lazy_cache.aget_many(['AsyncTests:a', 'AsyncTests:b']).get(), {
+            'AsyncTests:a': 1,
+            'AsyncTests:b': None,
+        })
+
+
+class CompressionTests(TestCase):
+
+    def test_compression(self):
+
+        lazy_cache = LazyCache(cache, compress_threshold=1000)
+        small_value = 'small'
+        big_value = 'big' * 10000
+
+        lazy_cache.set('CompressionTests:small', small_value)
+        lazy_cache.set_many({'CompressionTests:big': big_value})
+
+        # Only the big value gets compressed.
+        self.assertEqual(cache.get('CompressionTests:small'), small_value)
+        self.assertTrue(isinstance(cache.get('CompressionTests:big'), Compressed))
+        self.assertEqual(lazy_cache.compressed_values, 1)
+        self.assertTrue(lazy_cache.compressed_bytes_saved > 20000)
+
+        self.assertEqual(lazy_cache.get('CompressionTests:big'), big_value)
+        self.assertEqual(lazy_cache.get_many(['CompressionTests:small', 'CompressionTests:big']), {
+            'CompressionTests:small': small_value,
+            'CompressionTests:big': big_value,
+        })
+
+        # Compressed values can still be read after disabling compression.
+        lazy_cache = LazyCache(cache)
+        self.assertEqual(lazy_cache.get('CompressionTests:big'), big_value)
+
+
+class ChunkTests(TestCase):
+
+    def test_chunks(self):
+
+        lazy_cache = LazyCache(cache, chunk_size=1000)
+        small_value = 'small'
+        big_value = ''.join(chr(i % 251) for i in xrange(3500))
+
+        lazy_cache.set('ChunkTests:small', small_value)
+        lazy_cache.set_many({'ChunkTests:big': big_value})
+
+        # Only the big value gets split, into 4 chunks.
+        self.assertEqual(cache.get('ChunkTests:small'), small_value)
+        manifest = cache.get('ChunkTests:big')
+        self.assertTrue(isinstance(manifest, Chunked))
+        self.assertEqual(manifest.count, 4)
+        self.assertEqual(lazy_cache.chunked_values, 1)
+
+        self.assertEqual(lazy_cache.get('ChunkTests:big'), big_value)
+        self.assertEqual(lazy_cache.get_many(['ChunkTests:small', 'ChunkTests:big']), {
+            'ChunkTests:small': small_value,
+            'ChunkTests:big': big_value,
+        })
+
+        # Compressed values are split after compressing them.
+        compressed_cache = LazyCache(cache, chunk_size=1000, compress_threshold=1000)
+        compressed_cache.set('ChunkTests:compressed', big_value * 10)
+        self.assertTrue(cache.get('ChunkTests:compressed').codec)
+        self.assertEqual(compressed_cache.get('ChunkTests:compressed'), big_value * 10)
+
+        # A missing chunk is a miss.
+        cache.delete(manifest.get_keys('ChunkTests:big')[2])
+        self.assertEqual(lazy_cache.get('ChunkTests:big'), None)
+        self.assertEqual(lazy_cache.get_many(['ChunkTests:small', 'ChunkTests:big']), {
+            'ChunkTests:small': small_value,
+        })
+
+        # So is a chunk that does not match the checksum.
+        lazy_cache.add('ChunkTests:added', big_value)
+        manifest = cache.get('ChunkTests:added')
+        cache.set(manifest.get_keys('ChunkTests:added')[0], 'x' * 1000)
+        self.assertEqual(lazy_cache.get('ChunkTests:added'), None)
+
+
+class StatsTests(TestCase):
+
+    def test_stats(self):
+
+        lazy_cache = LazyCache(cache, stats=CacheStats(record_sizes=True))
+        lazy_cache.set('StatsTests:a', 1)
+        lazy_cache.get('StatsTests:a')
+        lazy_cache.get('StatsTests:missing')
+        lazy_cache.get_many(['StatsTests:a', 'StatsTests:missing', 'other:missing'])
+        lazy_cache.get_or_set('StatsTests:b', lambda: 2)
+
+        snapshot = lazy_cache.stats.snapshot()
+        self.assertEqual(snapshot['counters']['StatsTests'], {
+            'hits': 2,
+            'misses': 3,
+            'produced': 1,
+        })
+        self.assertEqual(snapshot['counters']['other'], {'misses': 1})
+        self.assertEqual(snapshot['latency']['get']['count'], 3)
+        self.assertEqual(snapshot['latency']['get_many']['count'], 1)
+        self.assertEqual(snapshot['sizes']['count'], 2)
+
+        lazy_cache.stats.reset()
+        self.assertEqual(lazy_cache.stats.snapshot()['counters'], {})
+
+    def test_cached_list_rebuilds(self):
+
+        lazy_cache = LazyCache(cache)
+        users = list(User.objects.all()[:3])
+
+        # Pickle the list, which caches its items, and then delete the
+        # cached items so that unpacking the list has to rebuild them.
+        user_cache = TestUserCachedList(users, cache_backend=lazy_cache)
+        pickled = pickle.dumps(user_cache)
+        cache.delete_many(list(user_cache.make_cache_keys(user.pk for user in users)))
+
+        user_cache = pickle.loads(pickled)
+        user_cache.cache_backend = lazy_cache
+        self.assertEqual([user.pk for user in users], [user.pk for user in user_cache])
+
+        counters = lazy_cache.stats.snapshot()['counters']
+        self.assertEqual(counters['TestUserCachedList']['rebuilds'], len(users))
+
+
+class NegativeCacheTests(TestCase):
+
+    def test_negative_timeout(self):
+
+        lazy_cache = LazyCache(cache, default_timeout=60, negative_timeout=1)
+
+        # None values are cached with the negative timeout.
+        lazy_cache.set('NegativeCacheTests:missing', None)
+        lazy_cache.set_many({'NegativeCacheTests:other': None, 'NegativeCacheTests:found': 1})
+        self.assertEqual(lazy_cache.get_many(['NegativeCacheTests:missing', 'NegativeCacheTests:other']), {
+            'NegativeCacheTests:missing': None,
+            'NegativeCacheTests:other': None,
+        })
+        time.sleep(1.1)
+        self.assertEqual(lazy_cache.get_many(['NegativeCacheTests:missing', 'NegativeCacheTests:other']), {})
+        self.assertEqual(lazy_cache.get('NegativeCacheTests:found'), 1)
+
+        # Setting a value replaces the cached None.
+        lazy_cache.set('NegativeCacheTests:missing', None)
+        lazy_cache.set('NegativeCacheTests:missing', 2)
+        self.assertEqual(lazy_cache.get('NegativeCacheTests:missing'), 2)
+
+
+class ShardedCacheTests(TestCase):
+
+    def test_hash_ring(self):
+
+        keys = ['ShardedCacheTests:%d' % number for number in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = [ring.get_node(key) for key in keys]
+        for node in 'abc':
+            self.assertTrue(200 < nodes.count(node) < 470)
+
+        # Adding a node only moves keys to that node.
+        new_nodes = [HashRing(['a', 'b', 'c', 'd']).get_node(key) for key in keys]
+        moved = [new_node for node, new_node in zip(nodes, new_nodes) if node != new_node]
+        self.assertEqual(set(moved), set(['d']))
+        self.assertTrue(150 < len(moved) < 350)
+
+    def test_sharded_cache(self):
+
+        sharded_cache = LocMemShardedCache(
+            aliases=['a', 'b'],
+            routes={'Lookup': ['c']},
+            pool=WorkerPool(workers=2),
+        )
+        data = dict(('Row:%d' % number, number) for number in range(20))
+        data['Lookup:1'] = 1
+
+        sharded_cache.set_many(data)
+        self.assertEqual(sharded_cache.get_many(data.keys() + ['Row:missing']), data)
+        self.assertEqual(sharded_cache.get_cache('c').get('Lookup:1'), 1)
+        for alias in ('a', 'b'):
+            self.assertTrue(sharded_cache.get_cache(alias).get_many(data.keys()))
+
+        lazy_cache = LazyCache(sharded_cache)
+        self.assertEqual(lazy_cache.get_or_set('Row:new', lambda: 'new'), 'new')
+        self.assertEqual(sharded_cache.get_shard('Row:new').get('Row:new'), lazy_cache.get('Row:new'))
+
+        sharded_cache.delete_many(data.keys())
+        self.assertEqual(sharded_cache.get_many(data.keys()), {})
+
+
+class HotKeysTests(TestCase):
+
+    def test_count_min_sketch(self):
+
+        sketch = CountMinSketch(width=100, depth=4)
+        for number in range(50):
+            sketch.add('HotKeysTests:%d' % number)
+        self.assertEqual(sketch.add('HotKeysTests:hot', 10), 10)
+        self.assertEqual(sketch.estimate('HotKeysTests:hot'), 10)
+        self.assertTrue(sketch.estimate('HotKeysTests:1') >= 1)
+
+        sketch.halve()
+        self.assertEqual(sketch.estimate('HotKeysTests:hot'), 5)
+
+    def test_hot_keys(self):
+
+        hot_keys = HotKeys(LocalCache(), threshold=3, sample_rate=1, max_keys=2)
+        lazy_cache = LazyCache(cache, hot_keys=hot_keys)
+        lazy_cache.set_many({'HotKeysTests:a': 1, 'HotKeysTests:b': 2, 'HotKeysTests:c': 3})
+
+        for number in range(3):
+            self.assertEqual(lazy_cache.get('HotKeysTests:a'), 1)
+        lazy_cache.get_many(['HotKeysTests:b', 'HotKeysTests:c'])
+        self.assertEqual(lazy_cache.get_hot_keys(), [('HotKeysTests:a', 3)])
+
+        # Hot keys are read from this process instead of the cache.
+        cache.set('HotKeysTests:a', 'changed')
+        self.assertEqual(lazy_cache.get('HotKeysTests:a'), 1)
+        self.assertEqual(lazy_cache.get_many(['HotKeysTests:a']), {'HotKeysTests:a': 1})
+
+        # Only the hottest keys are kept.
+        for number in range(4):
+            lazy_cache.get('HotKeysTests:c')
+        for number in range(3):
+            lazy_cache.get('HotKeysTests:b')
+        self.assertEqual(dict(lazy_cache.get_hot_keys()), {'HotKeysTests:a': 5, 'HotKeysTests:c': 5})
+
+        # Deleting a key removes the pinned value.
+        lazy_cache.delete('HotKeysTests:a')
+        self.assertEqual(lazy_cache.get('HotKeysTests:a'), None)
@@ -1,18 +1,29 @@
 import logging
 
+from itertools import izip
+
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 from django.db import models, DatabaseError
-from django.db.models.signals import m2m_changed, pre_delete, post_delete, post_save
-from django.db.models.base import ModelBase
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.fields.related import ForeignKey
+from django.db.models.query import QuerySet
 from django.utils.functional import SimpleLazyObject
 
+from lazycache import get_lazy_cache
 from lazymodel.backend import lazymodel_cache
+from lazymodel.invalidation import lazymodel_invalidation
+from lazymodel.serializers import build_instance
 from lazymodel.utils import (
     get_identifier,
     get_identifier_string,
+    get_model_label,
+    invalidate_model,
     lookup_cache_key,
     model_cache_key,
+    model_keys,
+    register_lookup_key,
+    write_through_enabled,
 )
 
 try:
@@ -22,6 +33,21 @@ except:
 else:
     DatabaseExceptions = (DatabaseError, psycopg2.Error)
 
+__all__ = (
+    'CachedGetManager',
+    'LazyModel',
+    'LazyModelDict',
+    'LazyModelError',
+    'MetaCaching',
+    'ModelWithCaching',
+    'RelatedFieldManager',
+    'RowCacheManager',
+    'RowCacheQuerySet',
+    'get_cached_objects',
+    'get_instances',
+    'prefetch_cached',
+)
+
 
 class LazyModelError(ValueError):
     pass
@@ -36,12 +62,15 @@ class LazyModel(SimpleLazyObject):
 
     Raises a LazyModelError (subclass of ValueError) if fail_silently=False.
 
+    The cache_backend can be a LazyCache, a Django cache, or a dictionary;
+    the latter two are wrapped in a LazyCache.
+
     """
 
     def __init__(self, object_or_string, *args, **kwargs):
         self._wrapped = None
         self.__dict__['_fail_silently'] = kwargs.pop('fail_silently', True)
-        self.__dict__['_cache_backend'] = kwargs.pop('cache_backend', lazymodel_cache)
+        self.__dict__['_cache_backend'] = get_lazy_cache(kwargs.pop('cache_backend', lazymodel_cache))
         self.__dict__['_setupfunc'] = self._get_cached_instance
         self.__dict__['_init_args'] = (object_or_string, args, kwargs)
 
@@ -92,11 +121,7 @@ class LazyModel(SimpleLazyObject):
         # and versioning the identifier.
         cache_key = model_cache_key(identifier)
 
-        try:
-            instance = self._cache_backend[cache_key]
-        except KeyError:
-            instance = self._get_instance(identifier)
-            self._cache_backend[cache_key] = instance
+        instance = self._cache_backend.get_or_set(cache_key, lambda: self._get_instance(identifier))
 
         if instance is None:
             if self._fail_silently:
@@ -122,6 +147,7 @@ class LazyModel(SimpleLazyObject):
 
     def _get_instance(self, identifier):
         """Get the object from the database."""
+        self._cache_backend.stats.incr('ModelCache', 'database_fallbacks')
         try:
             app_label, model, object_pk = identifier.split('.', 2)
             if object_pk == 'None':
@@ -175,6 +201,249 @@ class LazyModel(SimpleLazyObject):
 
         raise AttributeError
 
+    def aresolve(self):
+        """
+        Evaluate this instance in a background thread, using the executor
+        of the cache backend. Returns an AsyncResult; its get() method
+        waits for and returns the same value as evaluating the instance
+        (the object, or False if it was not found).
+
+        """
+
+        def resolve():
+            if self._wrapped is None:
+                self._setup()
+            return self._wrapped
+
+        return self._cache_backend._submit(resolve)
+
+    @classmethod
+    def aresolve_many(cls, lazy_models, cache_backend=lazymodel_cache):
+        """
+        Run resolve_many in a background thread, using the executor of the
+        cache backend. Returns an AsyncResult; its get() method waits for
+        the instances to be evaluated and then returns them as a list.
+
+        """
+
+        lazy_models = list(lazy_models)
+        cache_backend = get_lazy_cache(cache_backend)
+
+        def resolve():
+            cls.resolve_many(lazy_models)
+            return lazy_models
+
+        return cache_backend._submit(resolve)
+
+    @classmethod
+    def resolve_many(cls, lazy_models):
+        """
+        Evaluate many LazyModel instances together. Rather than doing one
+        cache request (and possibly one query) per instance, this fetches
+        every cache key with a single get_many call, loads the missed objects
+        with one query per model, and then adds them back with set_many.
+
+        Instances that have already been evaluated are skipped. Instances
+        with invalid identifiers are also skipped, leaving them to raise
+        errors as usual when they are accessed.
+
+        Usage:
+            authors = [LazyModel(User, pk) for pk in author_pks]
+            LazyModel.resolve_many(authors)
+
+        """
+
+        pending = {}
+        for lazy_model in lazy_models:
+            if lazy_model._wrapped is not None:
+                continue
+            try:
+                identifier = lazy_model._get_identifier()
+            except ValueError:
+                continue
+            cache_backend = lazy_model._cache_backend
+            backend_items = pending.setdefault(id(cache_backend), (cache_backend, {}))[1]
+            backend_items.setdefault(identifier, []).append(lazy_model)
+
+        for cache_backend, items in pending.values():
+
+            cache_keys = dict((model_cache_key(identifier), identifier) for identifier in items)
+            cached = cache_backend.get_many(cache_keys.keys())
+
+            instances = {}
+            missed = []
+            for cache_key, identifier in cache_keys.items():
+                if cache_key in cached:
+                    instances[identifier] = cached[cache_key]
+                else:
+                    missed.append(identifier)
+
+            if missed:
+                cache_backend.stats.incr('ModelCache', 'database_fallbacks', len(missed))
+                found = get_instances(missed)
+                cache_backend.set_many(dict(
+                    (model_cache_key(identifier), found.get(identifier))
+                    for identifier in missed
+                ))
+                for identifier in missed:
+                    instances[identifier] = found.get(identifier)
+
+            for identifier, instance in instances.items():
+                for lazy_model in items[identifier]:
+                    if instance is not None:
+                        lazy_model._wrapped = instance
+                    elif lazy_model._fail_silently:
+                        lazy_model._wrapped = False
+
+
+def get_instances(identifiers):
+    """
+    Get objects from the database for the given identifiers, using one
+    query per model. Returns a dictionary of the identifiers and their
+    objects. Identifiers that could not be found are left out.
+
+    """
+
+    pks_by_model = {}
+    for identifier in identifiers:
+        app_label, model, object_pk = identifier.split('.', 2)
+        if object_pk != 'None':
+            pks_by_model.setdefault((app_label, model), []).append(object_pk)
+
+    instances = {}
+    for (app_label, model), object_pks in pks_by_model.items():
+        try:
+            content_type = ContentType.objects.get_by_natural_key(app_label, model)
+            model_class = content_type.model_class()
+            queryset = model_class._base_manager.using(content_type._state.db)
+            for instance in queryset.filter(pk__in=object_pks):
+                instances[get_identifier(instance)] = instance
+        except ContentType.DoesNotExist:
+            logging.warning('Could not find content type for %s.%s' % (app_label, model))
+        except DatabaseExceptions:
+            raise
+        except Exception as error:
+            logging.error('Could not get related objects for %s.%s - %s' % (app_label, model, error))
+
+    return instances
+
+
+def get_cached_objects(queryset, id_list, cache_backend=lazymodel_cache):
+    """
+    Get objects for a list of pks from the row cache, using a single
+    get_many call. The missed objects are loaded from the queryset with one
+    query, and then added to the cache with set_many.
+
+    Returns the row cache keys of the pks, in the same order, and a
+    dictionary of those keys and the objects that were found.
+
+    """
+
+    id_list = list(id_list)
+    if not id_list:
+        return [], {}
+    cache_backend = get_lazy_cache(cache_backend)
+
+    model = queryset.model
+    pk_keys = model_keys.keys_for(model, id_list)
+    cached = cache_backend.get_many(pk_keys)
+    negative_caching = bool(cache_backend.negative_timeout)
+
+    results = {}
+    missed = {}
+    for object_pk, pk_key in izip(id_list, pk_keys):
+        result = cached.get(pk_key)
+        if result:
+            results[pk_key] = result
+        elif result is None and pk_key in cached and negative_caching:
+            # This object was cached as missing.
+            continue
+        else:
+            # LazyModel caches missing objects as None, so check the
+            # database in case it has been added since then.
+            missed[pk_key] = object_pk
+
+    if missed:
+        cache_backend.stats.incr('ModelCache', 'database_fallbacks', len(missed))
+        found = queryset.in_bulk(missed.values())
+        found_keys = model_keys.keys_for(model, found.keys())
+        results.update(izip(found_keys, found.values()))
+        if negative_caching:
+            new_items = dict((pk_key, results.get(pk_key)) for pk_key in missed)
+        else:
+            new_items = dict((pk_key, results[pk_key]) for pk_key in found_keys)
+        cache_backend.set_many(new_items)
+
+    return pk_keys, results
+
+
+def get_related_slot(obj, field_name):
+    """
+    Returns the attribute that caches the related object of a ForeignKey
+    or GenericForeignKey field on an object, along with the model and pk
+    of the related object. The model and pk are None if it is not set.
+
+    """
+
+    opts = obj._meta
+
+    for field in opts.virtual_fields:
+        if field.name == field_name and hasattr(field, 'ct_field'):
+            # This is a GenericForeignKey.
+            content_type_id = getattr(obj, opts.get_field(field.ct_field).attname)
+            object_pk = getattr(obj, field.fk_field)
+            if content_type_id is None or object_pk is None:
+                return field.cache_attr, None, None
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            return field.cache_attr, model, object_pk
+
+    field = opts.get_field(field_name)
+    if not isinstance(field, ForeignKey):
+        raise ValueError('%s.%s is not a ForeignKey or GenericForeignKey.' % (opts.object_name, field_name))
+    if field.rel.field_name != field.rel.to._meta.pk.name:
+        raise ValueError('%s.%s does not refer to a primary key.' % (opts.object_name, field_name))
+    object_pk = getattr(obj, field.attname)
+    if object_pk is None:
+        return field.get_cache_name(), None, None
+    return field.get_cache_name(), field.rel.to, object_pk
+
+
+def prefetch_cached(objects, *field_names):
+    """
+    Get the related objects of ForeignKey and GenericForeignKey fields for
+    many objects together, using the row cache. Rather than doing one cache
+    request per object when each field is accessed, this fetches the
+    related objects with one get_many call per related model, and loads the
+    missed objects with one query per related model.
+
+    The related objects are attached to the objects, so accessing the fields
+    afterwards does not use the cache or the database. Fields that were
+    already accessed are skipped. Returns the objects as a list.
+
+    Usage:
+        articles = prefetch_cached(Article.objects.all()[:20], 'author', 'category')
+
+    """
+
+    objects = list(objects)
+
+    slots_by_model = {}
+    for field_name in field_names:
+        for obj in objects:
+            cache_name, model, object_pk = get_related_slot(obj, field_name)
+            if model is None or hasattr(obj, cache_name):
+                continue
+            slots_by_model.setdefault(model, []).append((obj, cache_name, object_pk))
+
+    for model, slots in slots_by_model.items():
+        object_pks = [slot[2] for slot in slots]
+        pk_keys, results = get_cached_objects(model._base_manager.all(), object_pks)
+        for (obj, cache_name, object_pk), pk_key in izip(slots, pk_keys):
+            if pk_key in results:
+                setattr(obj, cache_name, results[pk_key])
+
+    return objects
+
 
 def unpickle_lazy_object(object_or_string, args, kwargs):
     return LazyModel(object_or_string, *args, **kwargs)
@@ -210,6 +479,40 @@ class LazyModelDict(dict):
             self[key] = item
             return item
 
+    def add_lazy(self, *args, **kwargs):
+        """
+        Like get_or_add, but the new LazyModel instance is not evaluated.
+        Use resolve_all afterwards to evaluate all of them together.
+
+        Usage:
+            items = LazyModelDict()
+            for pk in user_pks:
+                items.add_lazy(User, pk)
+            items.resolve_all()
+
+        """
+
+        key = LazyModel.get_identifier(*args, **kwargs)
+        try:
+            return self[key]
+        except KeyError:
+            item = LazyModel(*args, **kwargs)
+            self[key] = item
+            return item
+
+    def resolve_all(self):
+        """
+        Evaluate every LazyModel instance in this dictionary using
+        LazyModel.resolve_many. As with get_or_add, objects that could not
+        be found are replaced with None.
+
+        """
+
+        LazyModel.resolve_many(item for item in self.values() if item is not None)
+        for key, item in self.items():
+            if item is not None and not item:
+                self[key] = None
+
 
 class RelatedFieldManager(models.Manager):
 
@@ -267,6 +570,47 @@ class CachedGetManager(RelatedFieldManager):
         return super(CachedGetManager, self).get(*args, **kwargs)
 
 
+class RowCacheQuerySet(QuerySet):
+    """
+    A QuerySet that invalidates the cache for its model after changing rows
+    without sending signals. This relies on the LAZYMODEL_GENERATIONS
+    setting being enabled for the model; see lazymodel.utils.invalidate_model.
+
+    """
+
+    def bulk_create(self, *args, **kwargs):
+        result = super(RowCacheQuerySet, self).bulk_create(*args, **kwargs)
+        invalidate_model(self.model)
+        return result
+
+    def update(self, *args, **kwargs):
+        result = super(RowCacheQuerySet, self).update(*args, **kwargs)
+        invalidate_model(self.model)
+        return result
+
+
+_row_cache_queryset_classes = {}
+
+
+def get_row_cache_queryset_class(queryset_class):
+    """
+    Returns a subclass of a QuerySet class which also has the invalidation
+    of RowCacheQuerySet, so managers can keep using their own QuerySets.
+
+    """
+    if issubclass(queryset_class, RowCacheQuerySet):
+        return queryset_class
+    if queryset_class is QuerySet:
+        return RowCacheQuerySet
+    try:
+        return _row_cache_queryset_classes[queryset_class]
+    except KeyError:
+        name = 'RowCache%s' % queryset_class.__name__
+        new_class = type(name, (RowCacheQuerySet, queryset_class), {'__module__': queryset_class.__module__})
+        _row_cache_queryset_classes[queryset_class] = new_class
+        return new_class
+
+
 class RowCacheManager(RelatedFieldManager):
     """
     Manager for caching single-row queries. To make invalidation easy,
@@ -276,10 +620,40 @@ class RowCacheManager(RelatedFieldManager):
     this pk cache key should be invalidated. Doing two memcached queries is
     still faster than fetching from the database.
 
+    If LAZYMODEL_NEGATIVE_CACHE_SECONDS is set, then pk lookups for objects
+    that do not exist are cached as None for that many seconds, and raise
+    DoesNotExist without a query. Saving the object removes the cached None.
+    Other lookups that find nothing are cached as None in the same way, so
+    concurrent requests for them wait for one query rather than each doing
+    their own. Managers that only include some rows never cache objects as
+    missing.
+
+    The in_bulk and get_list methods get many objects by pk together, with
+    one cache request for all of them and one query for any that were not
+    cached. Managers that only include some rows, such as related managers,
+    use the database instead, because the cached rows are not filtered.
+
     """
 
     cache_backend = lazymodel_cache
 
+    def __init__(self, *args, **kwargs):
+        super(RowCacheManager, self).__init__(*args, **kwargs)
+        # Subclasses can use any cache backend, but this needs LazyCache.
+        self.cache_backend = get_lazy_cache(self.cache_backend)
+
+    def get_query_set(self):
+        base_get_query_set = super(RowCacheManager, self).get_query_set
+        if base_get_query_set.im_func is models.Manager.get_query_set.im_func:
+            return RowCacheQuerySet(self.model, using=self._db)
+        # Keep any filtering or QuerySet class from the other bases of the
+        # manager, since MetaCaching mixes this class into existing ones.
+        queryset = base_get_query_set()
+        queryset_class = get_row_cache_queryset_class(queryset.__class__)
+        if queryset_class is not queryset.__class__:
+            queryset = queryset._clone(klass=queryset_class)
+        return queryset
+
     def get(self, *args, **kwargs):
 
         if len(kwargs) == 1 and kwargs.keys()[0] in ('id', 'id__exact', 'pk', 'pk__exact'):
@@ -303,72 +677,171 @@ class RowCacheManager(RelatedFieldManager):
             else:
                 lookup_key = lookup_cache_key(self.model, **kwargs)
 
-            # Try to get the cached pk_key.
-            object_pk = self.cache_backend.get(lookup_key)
-            pk_key = object_pk and model_cache_key(self.model, object_pk)
+            # Get the cached pk for this lookup, or get the object from the
+            # database and cache its pk against the lookup. Next time the
+            # same lookup is requested, it will find the relevent pk and be
+            # able to get the cached object using that. Concurrent requests
+            # for the same lookup will wait for this rather than doing the
+            # same query.
+            fetched = []
+            negative_caching = self._caches_missing()
 
-        # Try to get a cached result if the pk_key is known.
-        result = pk_key and self.cache_backend.get(pk_key)
+            def get_object_pk():
+                try:
+                    result = self._get_and_cache(None, *args, **kwargs)
+                except self.model.DoesNotExist:
+                    if negative_caching:
+                        # Cache the lookup as missing before the lock is
+                        # released, so the waiting requests find that
+                        # rather than each doing the query again.
+                        return None
+                    raise
+                fetched.append(result)
+                return result.pk
+
+            object_pk = self.cache_backend.get_or_set(lookup_key, get_object_pk)
+            if fetched:
+                # The lookup has been cached, so it can be added to the index.
+                register_lookup_key(self.model, object_pk, lookup_key)
+                return fetched[0]
+            if object_pk is None:
+                # A missing object was cached against this lookup.
+                if negative_caching:
+                    raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+                return self._get_and_cache(lookup_key, *args, **kwargs)
+            return self._get_by_lookup_pk(lookup_key, object_pk, *args, **kwargs)
+
+        # Get the cached result using the pk_key, or get it from the
+        # database and cache it. Concurrent requests for the same object
+        # will wait for this rather than doing the same query.
+        negative_caching = self._caches_missing()
+        if negative_caching:
+            # Cache missing objects as None, which only lasts for the
+            # negative timeout, or until the object gets saved.
+            producer = lambda: self._get_from_database_or_none(*args, **kwargs)
+        else:
+            producer = lambda: self._get_from_database(*args, **kwargs)
+        result = self.cache_backend.get_or_set(pk_key, producer)
 
         if not result:
+            if negative_caching:
+                raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+            # LazyModel caches missing objects as None, so check the
+            # database in case it has been added since then.
+            result = self._get_and_cache(lookup_key, *args, **kwargs)
+
+        # Return the cache-protected object.
+        return result
 
-            # The result was not cached, so get it from the database.
-            result = super(RowCacheManager, self).get(*args, **kwargs)
-            object_pk = result.pk
+    def _get_by_lookup_pk(self, lookup_key, object_pk, *args, **kwargs):
+        """
+        Get the object for a lookup that has its pk cached, using the
+        cached object if there is one. Otherwise the object is loaded by
+        its pk, and only cached if it still matches the lookup. If it has
+        been deleted, or no longer matches, then the cached lookup is
+        deleted and the lookup is done again.
+
+        """
 
-            # And cache the result against the pk_key for next time.
-            pk_key = model_cache_key(result, object_pk)
-            self.cache_backend[pk_key] = result
+        pk_key = model_cache_key(self.model, object_pk)
+        pk_kwargs = dict(kwargs)
+        pk_kwargs['pk'] = object_pk
+        try:
+            result = self.cache_backend.get_or_set(pk_key, lambda: self._get_from_database(*args, **pk_kwargs))
+        except self.model.DoesNotExist:
+            result = None
 
-            # If a lookup was used, then cache the pk against it. Next time
-            # the same lookup is requested, it will find the relevent pk and
-            # be able to get the cached object using that.
-            if lookup_key:
-                self.cache_backend[lookup_key] = object_pk
+        if not result:
+            # The cached lookup refers to an object that has changed.
+            self.cache_backend.delete(lookup_key)
+            result = self._get_and_cache(lookup_key, *args, **kwargs)
 
-        # Return the cache-protected object.
         return result
 
+    def _is_filtered(self, queryset):
+        """Check if a queryset from this manager only includes some rows."""
+        return bool(getattr(self, 'core_filters', None)) or bool(queryset.query.where)
 
-class MetaCaching(ModelBase):
-    """
-    Sets .objects on any model that inherits from ModelWithCaching to be a
-    RowCacheManager. This is tightly coupled to Django internals, so it could
-    break if you upgrade Django. This was done partially as a proof-of-concept.
+    def _caches_missing(self):
+        """
+        Check if missing objects should be cached as None. A manager that
+        only includes some rows, such as a related manager, can miss objects
+        that exist, so it must not cache them as missing for everything
+        else that uses the cache.
 
-    """
+        """
+        if not self.cache_backend.negative_timeout:
+            return False
+        return not self._is_filtered(self.get_query_set())
 
-    def __new__(*args, **kwargs):
-        new_class = ModelBase.__new__(*args, **kwargs)
-        new_manager = RowCacheManager()
-        if not hasattr(new_class, 'objects'):
-            # Attach a new manager.
-            new_manager.contribute_to_class(new_class, 'objects')
-            new_class._default_manager = new_manager
-        else:
-            # Mix in the manager into the existing one.
-            if new_class.objects.__class__ != RowCacheManager and RowCacheManager not in new_class.objects.__class__.__bases__:
-                new_class.objects.__class__.__bases__ = (RowCacheManager,) + new_class.objects.__class__.__bases__
-        return new_class
+    def in_bulk(self, id_list):
+        """
+        Returns a dictionary of pks and objects, like QuerySet.in_bulk,
+        using the cache where possible.
+
+        """
+        queryset = self.get_query_set()
+        if self._is_filtered(queryset):
+            return queryset.in_bulk(id_list)
+        pk_keys, results = get_cached_objects(queryset, id_list, self.cache_backend)
+        return dict((result.pk, result) for result in results.values())
+
+    def get_list(self, id_list):
+        """
+        Returns the objects for a list of pks, in the same order. Objects
+        that do not exist are left out.
+
+        This gets every cache key with a single get_many call, loads the
+        missed objects with one query, and then adds them back with set_many.
+
+        Usage:
+            articles = Article.objects.get_list(article_pks)
+
+        """
+
+        queryset = self.get_query_set()
+        if self._is_filtered(queryset):
+            id_list = list(id_list)
+            found = dict((str(pk), result) for pk, result in queryset.in_bulk(id_list).items())
+            return [found[str(pk)] for pk in id_list if str(pk) in found]
+        pk_keys, results = get_cached_objects(queryset, id_list, self.cache_backend)
+        return [results[pk_key] for pk_key in pk_keys if pk_key in results]
+
+    def _get_from_database(self, *args, **kwargs):
+        self.cache_backend.stats.incr('ModelCache', 'database_fallbacks')
+        return super(RowCacheManager, self).get(*args, **kwargs)
+
+    def _get_from_database_or_none(self, *args, **kwargs):
+        try:
+            return self._get_from_database(*args, **kwargs)
+        except self.model.DoesNotExist:
+            return None
+
+    def _get_and_cache(self, lookup_key, *args, **kwargs):
+        """
+        Get the object from the database, and cache it against its pk_key,
+        and its pk against the lookup_key if one is provided.
 
+        """
+
+        result = self._get_from_database(*args, **kwargs)
+        object_pk = result.pk
 
-class ModelWithCaching(models.Model):
+        pk_key = model_cache_key(result, object_pk)
+        self.cache_backend[pk_key] = result
 
-    __metaclass__ = MetaCaching
+        if lookup_key:
+            self.cache_backend[lookup_key] = object_pk
+            register_lookup_key(self.model, object_pk, lookup_key)
 
-    class Meta:
-        abstract = True
+        return result
 
-    # If we ever have issues with related fields being cached, use this:
-    #def __reduce__(self):
-    #    default = super(ModelWithCaching, self).__reduce__()
-    #    (model_unpickle, (model, defers, factory), data) = default
-    #    for field in self._meta.fields:
-    #        if hasattr(field, 'get_cache_name'):
-    #            cache_name = field.get_cache_name()
-    #            if cache_name in data:
-    #                del data[cache_name]
-    #    return (model_unpickle, (model, defers, factory), data)
+
+# The model classes are defined in a submodule, because Django works out
+# their app_label from the name of the module that they are defined in.
+# They are re-exported here (see __all__), after RowCacheManager has been
+# defined, because the submodule imports it from this module.
+from lazymodel.base import MetaCaching, ModelWithCaching
 
 
 def remove_object_from_cache(sender, instance, **kwargs):
@@ -377,13 +850,61 @@ def remove_object_from_cache(sender, instance, **kwargs):
         # in a content type instead of the model. At this point though, we are
         # actually working with the content type itself and not the model it
         # represents. So we need to bypass that special handling code.
-        cache_key = model_cache_key(get_identifier_string(instance, instance.pk))
+        identifier = get_identifier_string(instance, instance.pk)
+    else:
+        identifier = get_identifier(instance)
+
+    # Delete the cached object, along with any cached lookups that refer
+    # to it, because the lookup values may have changed.
+    lazymodel_invalidation.invalidate(identifier, using=kwargs.get('using'))
+
+
+def get_cacheable_instance(instance):
+    """
+    Returns a copy of a model instance that looks like it was loaded from
+    the database, so it can be cached in place of the instance. The field
+    values are converted to their Python types, and any cached related
+    objects are left out.
+
+    """
+    model = instance.__class__
+    values = []
+    for field in model._meta.fields:
+        value = getattr(instance, field.attname)
+        if isinstance(field, ForeignKey):
+            # Convert foreign key values using the field they refer to.
+            values.append(field.rel.get_related_field().to_python(value))
+        else:
+            values.append(field.to_python(value))
+    return build_instance(model, values, instance._state.db)
+
+
+def update_object_in_cache(sender, instance, raw=False, using=None, **kwargs):
+    """
+    When an object is saved, replace its cached version with the saved one
+    if LAZYMODEL_WRITE_THROUGH is enabled for its model, so the next request
+    for it does not need a query. The cached lookups that refer to it are
+    still deleted, because the lookup values may have changed.
+
+    Changes that get rolled back must never be cached, so inside a managed
+    transaction the cached object is deleted instead, as it is for other
+    models. Use lazymodel_invalidation.commit_on_success() or the lazymodel
+    TransactionMiddleware to cache the object once the transaction has
+    been committed.
+
+    """
+
+    if raw or instance._deferred or isinstance(instance, ContentType):
+        write_through = False
     else:
-        cache_key = model_cache_key(instance)
-    lazymodel_cache.delete(cache_key)
+        write_through = write_through_enabled(get_model_label(instance))
+    if not write_through:
+        return remove_object_from_cache(sender, instance, using=using, **kwargs)
+
+    identifier = get_identifier(instance)
+    lazymodel_invalidation.invalidate(identifier, get_cacheable_instance(instance), using=using)
 
 
-pre_delete.connect(remove_object_from_cache)
 post_delete.connect(remove_object_from_cache)
-post_save.connect(remove_object_from_cache)
+post_save.connect(update_object_in_cache)
 m2m_changed.connect(remove_object_from_cache)
@@ -1,10 +1,186 @@
+from importlib import import_module
+
 from django.conf import settings
 from django.core.cache import cache
+from django.db import connections
 
 from lazycache import LazyCache
+from lazycache.hotkeys import HotKeys
+from lazycache.local import Generations, LocalCache
+from lazycache.pool import WorkerPool
+from lazycache.sharded import ShardedCache
 
 
-lazymodel_cache = LazyCache(
+def get_model_label(cache_key):
+    """
+    Returns the "app_label.model" part of a model or lookup cache key,
+    which is used to group keys for invalidating the local cache.
+
+    """
+    if cache_key.startswith('ModelCache'):
+        identifier = cache_key.rsplit(':', 1)[-1]
+        return '.'.join(identifier.split('.', 2)[:2])
+
+
+def get_local_cache():
+    """
+    Returns a LocalCache using the LAZYMODEL_LOCAL_CACHE setting, or None
+    if it is not enabled. The setting is a dictionary of LocalCache options,
+    plus "generation_interval" which is the number of seconds that it may
+    take for changes made by other processes to become visible.
+
+    Example:
+        LAZYMODEL_LOCAL_CACHE = {
+            'max_entries': 1000,
+            'max_bytes': 1024 * 1024 * 10,
+            'timeout': 5,
+            'generation_interval': 1,
+        }
+
+    """
+
+    options = getattr(settings, 'LAZYMODEL_LOCAL_CACHE', None)
+    if not options:
+        return None
+
+    options = dict(options)
+    generations = Generations(
+        cache=cache,
+        namespace='ModelCacheGeneration',
+        interval=options.pop('generation_interval', 1),
+    )
+    return LocalCache(generations=generations, get_group=get_model_label, **options)
+
+
+def get_hot_keys():
+    """
+    Returns a HotKeys object for keeping the most popular objects in this
+    process, using the LAZYMODEL_HOT_KEYS setting, or None if it is not
+    enabled. The setting is a dictionary of HotKeys options, plus "timeout"
+    which is how often the pinned values are refreshed from the cache, and
+    "generation_interval" which is the number of seconds that it may take
+    for changes made by other processes to become visible.
+
+    Example:
+        LAZYMODEL_HOT_KEYS = {
+            'threshold': 1000,
+            'sample_rate': 0.01,
+            'interval': 60,
+            'max_keys': 100,
+            'timeout': 2,
+            'generation_interval': 1,
+        }
+
+    """
+
+    options = getattr(settings, 'LAZYMODEL_HOT_KEYS', None)
+    if not options:
+        return None
+
+    options = dict(options)
+    # Use the same generations as the local cache,
+    # so that either one can invalidate the other.
+    generations = Generations(
+        cache=cache,
+        namespace='ModelCacheGeneration',
+        interval=options.pop('generation_interval', 1),
+    )
+    local_cache = LocalCache(
+        max_entries=options.get('max_keys', 100),
+        timeout=options.pop('timeout', 2),
+        generations=generations,
+        get_group=get_model_label,
+    )
+    return HotKeys(local_cache, **options)
+
+
+def close_connections():
+    """Close database connections opened by a background thread."""
+    for connection in connections.all():
+        connection.close()
+
+
+def get_refresh_pool():
+    """
+    Returns a WorkerPool for refreshing stale values in the background,
+    or None if stale values are not enabled with LAZYMODEL_CACHE_STALE_SECONDS.
+    The LAZYMODEL_REFRESH_WORKERS and LAZYMODEL_REFRESH_MAX_PENDING settings
+    limit how many refreshes can run or be waiting to run at once.
+
+    """
+    if not getattr(settings, 'LAZYMODEL_CACHE_STALE_SECONDS', None):
+        return None
+    return WorkerPool(
+        workers=int(getattr(settings, 'LAZYMODEL_REFRESH_WORKERS', 2)),
+        max_pending=int(getattr(settings, 'LAZYMODEL_REFRESH_MAX_PENDING', 100)),
+        finalizer=close_connections,
+    )
+
+
+def get_serializer():
+    """
+    Returns the serializer for cached model instances, using the
+    LAZYMODEL_SERIALIZER setting. This is the import path of a class
+    such as "lazymodel.serializers.FieldTupleSerializer", or None to
+    store instances as they are.
+
+    """
+    path = getattr(settings, 'LAZYMODEL_SERIALIZER', None)
+    if not path:
+        return None
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+def get_row_cache():
+    """
+    Returns the Django cache for storing objects and lookups. This is the
+    default cache, unless the LAZYMODEL_CACHES setting is used to spread
+    them across several caches with a ShardedCache. The setting is a
+    dictionary of ShardedCache options, plus "workers" which is the number
+    of threads for calling the caches in parallel (the number of aliases
+    by default, or 0 to call them one at a time).
+
+    Example:
+        LAZYMODEL_CACHES = {
+            'aliases': ['rows1', 'rows2', 'rows3'],
+            'routes': {'ModelCacheLookup': ['lookups']},
+        }
+
+    """
+
+    options = getattr(settings, 'LAZYMODEL_CACHES', None)
+    if not options:
+        return cache
+
+    options = dict(options)
+    workers = options.pop('workers', len(options['aliases']))
+    if workers:
+        options['pool'] = WorkerPool(workers=workers)
+    return ShardedCache(**options)
+
+
+# Generation numbers for models, which are included in their cache keys when
+# enabled with the LAZYMODEL_GENERATIONS setting. See lazymodel.utils.
+lazymodel_generations = Generations(
     cache=cache,
+    namespace='ModelGeneration',
+    interval=getattr(settings, 'LAZYMODEL_GENERATION_INTERVAL', 1),
+)
+
+
+lazymodel_cache = LazyCache(
+    cache=get_row_cache(),
     default_timeout=int(getattr(settings, 'LAZYMODEL_CACHE_SECONDS', 60 * 60 * 24)),
+    local_cache=get_local_cache(),
+    stale_timeout=getattr(settings, 'LAZYMODEL_CACHE_STALE_SECONDS', None),
+    refresh_pool=get_refresh_pool(),
+    executor=WorkerPool(
+        workers=int(getattr(settings, 'LAZYMODEL_EXECUTOR_WORKERS', 4)),
+        finalizer=close_connections,
+    ),
+    serializer=get_serializer(),
+    compress_threshold=getattr(settings, 'LAZYMODEL_COMPRESS_THRESHOLD', None),
+    negative_timeout=getattr(settings, 'LAZYMODEL_NEGATIVE_CACHE_SECONDS', None),
+    hot_keys=get_hot_keys(),
 )
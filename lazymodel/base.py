@@ -0,0 +1,45 @@
+from django.db import models
+from django.db.models.base import ModelBase
+
+from lazymodel import RowCacheManager
+
+
+class MetaCaching(ModelBase):
+    """
+    Sets .objects on any model that inherits from ModelWithCaching to be a
+    RowCacheManager. This is tightly coupled to Django internals, so it could
+    break if you upgrade Django. This was done partially as a proof-of-concept.
+
+    """
+
+    def __new__(*args, **kwargs):
+        new_class = ModelBase.__new__(*args, **kwargs)
+        new_manager = RowCacheManager()
+        if not hasattr(new_class, 'objects'):
+            # Attach a new manager.
+            new_manager.contribute_to_class(new_class, 'objects')
+            new_class._default_manager = new_manager
+        else:
+            # Mix in the manager into the existing one.
+            if new_class.objects.__class__ != RowCacheManager and RowCacheManager not in new_class.objects.__class__.__bases__:
+                new_class.objects.__class__.__bases__ = (RowCacheManager,) + new_class.objects.__class__.__bases__
+        return new_class
+
+
+class ModelWithCaching(models.Model):
+
+    __metaclass__ = MetaCaching
+
+    class Meta:
+        abstract = True
+
+    # If we ever have issues with related fields being cached, use this:
+    #def __reduce__(self):
+    #    default = super(ModelWithCaching, self).__reduce__()
+    #    (model_unpickle, (model, defers, factory), data) = default
+    #    for field in self._meta.fields:
+    #        if hasattr(field, 'get_cache_name'):
+    #            cache_name = field.get_cache_name()
+    #            if cache_name in data:
+    #                del data[cache_name]
+    #    return (model_unpickle, (model, defers, factory), data)
@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+from threading import local
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from lazymodel.backend import lazymodel_cache
+from lazymodel.utils import get_invalidation_keys, in_transaction, model_cache_key
+
+
+class InvalidationBuffer(local):
+    """
+    Deletes the cached versions of objects that have changed, along with any
+    cached lookups that refer to them, or replaces them with the changed
+    objects for models that use LAZYMODEL_WRITE_THROUGH.
+
+    This uses one get_many call for the lookup indexes and one delete_many
+    call for every chunk_size objects. If there is no transaction, it is done
+    straight away. Inside a transaction, the cached objects are deleted
+    straight away, because Django does not say whether the transaction
+    was committed.
+
+    Use commit_on_success() in place of transaction.commit_on_success, or
+    lazymodel.middleware.TransactionMiddleware in place of Django's, to
+    wait for the transaction instead. Everything that changes is handled
+    together once the transaction has finished, and objects that change
+    several times are only handled once. If the transaction was committed,
+    then write through objects are cached. If it was rolled back, then
+    they are deleted. Changes must be rolled back by raising an exception
+    out of the block, rather than by calling transaction.rollback().
+
+    Usage:
+        with lazymodel_invalidation.commit_on_success():
+            import_rows()
+
+    Within a deferred() block, everything waits until the end of the block,
+    whether or not there is a transaction. Put the block around the code
+    that commits the transaction, so the cache is updated after the commit.
+    Objects that are cached as part of a transaction are deleted instead,
+    because the block cannot tell if the transaction was committed.
+
+    Usage:
+        with lazymodel_invalidation.deferred():
+            import_rows()  # Uses transaction.commit_on_success
+
+    Objects changed within either block may still be read from the cache
+    with their old values until the block ends.
+
+    """
+
+    chunk_size = 500
+
+    def __init__(self, cache_backend=lazymodel_cache):
+        self.cache_backend = cache_backend
+        self.depth = 0
+        self.pending = {}
+        self.transactions = {}
+
+    @contextmanager
+    def deferred(self):
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.flush()
+
+    @contextmanager
+    def commit_on_success(self, using=None):
+        """
+        Use transaction.commit_on_success, and update the cache for the
+        objects changed within it once the transaction has finished.
+
+        """
+        self.begin(using)
+        committed = False
+        try:
+            with transaction.commit_on_success(using=using):
+                yield
+            committed = True
+        finally:
+            self.end(committed, using)
+
+    def begin(self, using=None):
+        """
+        Start waiting for a transaction to finish before updating the cache.
+        Calls can be nested, and each one must be followed by end().
+
+        """
+        using = using or DEFAULT_DB_ALIAS
+        if using in self.transactions:
+            self.transactions[using][0] += 1
+        else:
+            self.transactions[using] = [1, {}]
+
+    def end(self, committed, using=None):
+        """
+        Finish waiting for a transaction. If it was rolled back, then every
+        object changed so far is deleted rather than cached. The cache is
+        updated when the outermost begin() has ended.
+
+        """
+        using = using or DEFAULT_DB_ALIAS
+        state = self.transactions[using]
+        items = state[1]
+        if not committed:
+            for identifier in items:
+                items[identifier] = None
+        state[0] -= 1
+        if not state[0]:
+            del self.transactions[using]
+            self.apply(items)
+
+    def invalidate(self, identifier, instance=None, using=None):
+        """
+        Delete the cached object for an identifier, and its cached lookups.
+        If an instance is provided, then it is cached instead of deleted.
+
+        """
+
+        if self.depth:
+            if instance is not None and in_transaction(using):
+                instance = None
+            self.pending[identifier] = instance
+            return
+
+        state = self.transactions.get(using or DEFAULT_DB_ALIAS)
+        if state is not None:
+            state[1][identifier] = instance
+            return
+
+        if instance is not None and in_transaction(using):
+            # The transaction might be rolled back, so only delete.
+            instance = None
+        self.apply({identifier: instance})
+
+    def flush(self):
+        """Apply everything that is waiting for a deferred() block."""
+        items, self.pending = self.pending, {}
+        if items:
+            self.apply(items)
+
+    def apply(self, items):
+        """
+        Update the cache for a dictionary of identifiers and the instances
+        to cache for them, or None to delete them.
+
+        """
+
+        identifiers = list(items)
+        for start in xrange(0, len(identifiers), self.chunk_size):
+            chunk = identifiers[start:start + self.chunk_size]
+            cache_keys = get_invalidation_keys(chunk)
+            new_items = {}
+            for identifier in chunk:
+                pk_key = model_cache_key(identifier)
+                if items[identifier] is None:
+                    cache_keys.append(pk_key)
+                else:
+                    new_items[pk_key] = items[identifier]
+            self.cache_backend.delete_many(cache_keys)
+            if new_items:
+                self.cache_backend.set_many(new_items)
+
+
+lazymodel_invalidation = InvalidationBuffer()
@@ -0,0 +1,58 @@
+from django.db.models import Model
+
+from lazycache.lists import CachedList
+from lazymodel.backend import lazymodel_cache
+from lazymodel.utils import model_keys
+
+
+class ModelCachedList(CachedList):
+    """
+    A CachedList of model instances, which caches each instance using the
+    same cache key as RowCacheManager and LazyModel. The instances are
+    shared with those, so they are kept up to date by the same signal
+    handlers, and rebuilding a missing item also refreshes the row cache.
+    Caching the list only adds items that are missing from the row cache,
+    so it does not replace objects that were saved since it was loaded.
+
+    All items must be instances of the same model. Instances loaded with
+    only() or defer() should not be used, because they would be cached
+    for everything else that uses the row cache.
+
+    Usage:
+        users = ModelCachedList.from_queryset(User.objects.filter(is_staff=True))
+        users.cache('staff-users')
+
+    """
+
+    replace_cached_items = False
+
+    def __init__(self, items, cache_backend=lazymodel_cache, cache_timeout=None, model=None):
+        super(ModelCachedList, self).__init__(items, cache_backend, cache_timeout)
+        if model is None and list.__len__(self):
+            # When unpickling, the items are pks and the model is restored
+            # afterwards, so only look at the items if they are instances.
+            item = list.__getitem__(self, 0)
+            if isinstance(item, Model):
+                model = item.__class__
+                if getattr(model, '_deferred', False):
+                    model = model._meta.proxy_for_model
+        self.model = model
+
+    @classmethod
+    def from_queryset(cls, queryset, **kwargs):
+        """Create a list of the objects in a queryset."""
+        return cls(list(queryset), model=queryset.model, **kwargs)
+
+    def _init_kwargs(self):
+        init_kwargs = super(ModelCachedList, self)._init_kwargs()
+        init_kwargs['model'] = self.model
+        return init_kwargs
+
+    def identify_items(self, items):
+        return [item.pk for item in items]
+
+    def make_cache_keys(self, identifiers):
+        return model_keys.keys_for(self.model, identifiers)
+
+    def rebuild_items(self, identifiers):
+        return self.model._base_manager.filter(pk__in=identifiers)
@@ -0,0 +1,38 @@
+from django.middleware import transaction
+
+from lazymodel.invalidation import lazymodel_invalidation
+
+
+class TransactionMiddleware(transaction.TransactionMiddleware):
+    """
+    Django's TransactionMiddleware, which also waits for the transaction to
+    finish before updating the cache for the objects changed during the
+    request. See InvalidationBuffer for details. Use this in place of
+    django.middleware.transaction.TransactionMiddleware.
+
+    """
+
+    def process_request(self, request):
+        super(TransactionMiddleware, self).process_request(request)
+        lazymodel_invalidation.begin()
+        request._lazymodel_transaction = True
+
+    def process_exception(self, request, exception):
+        super(TransactionMiddleware, self).process_exception(request, exception)
+        self._end(request, committed=False)
+
+    def process_response(self, request, response):
+        committed = False
+        try:
+            response = super(TransactionMiddleware, self).process_response(request, response)
+            committed = True
+        finally:
+            self._end(request, committed)
+        return response
+
+    def _end(self, request, committed):
+        # Responses are processed after exceptions, and can be processed
+        # without the request if other middleware returned a response first.
+        if getattr(request, '_lazymodel_transaction', False):
+            request._lazymodel_transaction = False
+            lazymodel_invalidation.end(committed)
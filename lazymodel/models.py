@@ -1,5 +1,3 @@
-# TODO: define these models and get tests working again
-
 from django.db import models
 
 from lazymodel import ModelWithCaching
@@ -10,4 +8,7 @@ class Account(ModelWithCaching):
 
 
 class PhotoGallery(ModelWithCaching):
-    pass
+    slug = models.SlugField()
+
+    def get_absolute_url(self):
+        return '/galleries/%s/' % self.slug
@@ -0,0 +1,122 @@
+import marshal
+import zlib
+
+from django.db.models import Model, get_model
+
+
+def build_instance(model, values, db):
+    """
+    Build a model instance from its field values, the same way that a
+    QuerySet does when loading rows from the database.
+
+    """
+    instance = model(*values)
+    instance._state.adding = False
+    instance._state.db = db
+    return instance
+
+
+class PackedModel(tuple):
+    """
+    A model instance that has been reduced to its field values. Contains the
+    serializer version, model label, schema checksum, database alias, marshal
+    version (or None if not marshalled) and the field values.
+
+    """
+    pass
+
+
+class PickleSerializer(object):
+    """
+    Stores model instances as they are. The cache backend will pickle them,
+    including their _state and any cached related objects.
+
+    """
+
+    def dumps(self, value):
+        return value
+
+    def loads(self, value):
+        return value
+
+
+class FieldTupleSerializer(object):
+    """
+    Stores model instances as a tuple of their concrete field values, which
+    is much smaller and faster to unpickle than the whole instance. Cached
+    related objects are not stored. Other values are stored as they are.
+
+    The tuple includes a checksum of the model's fields. If the fields have
+    changed since the value was cached, then it will be treated as a miss.
+
+    If use_marshal is enabled, then the field values are encoded with the
+    marshal module when possible, which is faster than pickle. Values such
+    as dates cannot be marshalled, so those rows are stored as a plain tuple
+    instead.
+
+    """
+
+    version = 1
+
+    def __init__(self, use_marshal=True):
+        self.use_marshal = use_marshal
+        self._schemas = {}
+
+    def get_schema(self, model):
+        try:
+            return self._schemas[model]
+        except KeyError:
+            fields = tuple((field.attname, field.get_internal_type()) for field in model._meta.fields)
+            schema = zlib.crc32(repr(fields)) & 0xffffffff
+            self._schemas[model] = schema
+            return schema
+
+    def dumps(self, value):
+
+        if not isinstance(value, Model) or value._deferred:
+            return value
+
+        model = value.__class__
+        values = tuple(getattr(value, field.attname) for field in model._meta.fields)
+
+        marshal_version = None
+        if self.use_marshal:
+            try:
+                values = marshal.dumps(values)
+            except ValueError:
+                pass
+            else:
+                marshal_version = marshal.version
+
+        return PackedModel((
+            self.version,
+            model._meta.app_label,
+            model._meta.module_name,
+            self.get_schema(model),
+            value._state.db,
+            marshal_version,
+            values,
+        ))
+
+    def loads(self, value):
+
+        if not isinstance(value, PackedModel):
+            return value
+
+        (version, app_label, module_name, schema, db, marshal_version, values) = value
+
+        if version != self.version:
+            raise ValueError('Unsupported serializer version %r.' % version)
+
+        model = get_model(app_label, module_name)
+        if model is None:
+            raise ValueError('Unknown model %s.%s.' % (app_label, module_name))
+        if schema != self.get_schema(model):
+            raise ValueError('The fields of %s.%s have changed.' % (app_label, module_name))
+
+        if marshal_version is not None:
+            if marshal_version != marshal.version:
+                raise ValueError('Unsupported marshal version %r.' % marshal_version)
+            values = marshal.loads(values)
+
+        return build_instance(model, values, db)
@@ -1,14 +1,51 @@
 import pickle
+import threading
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Permission, User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
-
-from lazymodel import LazyModel, LazyModelDict, ModelWithCaching
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.query import QuerySet
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase, TransactionTestCase
+
+import lazycache
+from lazycache.local import LocalCache
+from lazymodel import (
+    LazyModel,
+    LazyModelDict,
+    ModelWithCaching,
+    RowCacheManager,
+    RowCacheQuerySet,
+    prefetch_cached,
+)
 from lazymodel.backend import lazymodel_cache
+from lazymodel.invalidation import lazymodel_invalidation
+from lazymodel.lists import ModelCachedList
+from lazymodel.middleware import TransactionMiddleware
 from lazymodel.models import Account, PhotoGallery
-from lazymodel.utils import get_identifier, lookup_cache_key, model_cache_key
+from lazymodel.serializers import FieldTupleSerializer
+from lazymodel import utils
+from lazymodel.utils import (
+    get_identifier,
+    get_lookup_keys,
+    lookup_cache_key,
+    lookup_hasher,
+    model_cache_key,
+    model_keys,
+    register_lookup_key,
+    versioned_cache_key,
+)
+
+
+class GalleryCollection(models.Model):
+    """A model for testing related managers of PhotoGallery."""
+
+    galleries = models.ManyToManyField(PhotoGallery, related_name='collections')
+
+    class Meta:
+        app_label = 'lazymodel'
 
 
 class ModelCacheTests(TestCase):
@@ -44,6 +81,161 @@ class ModelCacheTests(TestCase):
         key_after = model_cache_key(gallery)
         self.assertNotEqual(key_before, key_after)
 
+    def test_generations(self):
+        """
+        Ensure that updating rows without signals will change the
+        cache keys of the model when generations are enabled, so the
+        old values are not used, even from the local cache.
+
+        """
+
+        gallery = PhotoGallery.objects.create(slug='generations')
+
+        settings.LAZYMODEL_GENERATIONS = ['lazymodel.photogallery']
+        local_cache = lazymodel_cache.local_cache
+        lazymodel_cache.local_cache = LocalCache()
+        try:
+            pk_key = model_cache_key(gallery)
+            lookup_key = lookup_cache_key(PhotoGallery, slug='generations')
+            self.assertEqual(PhotoGallery.objects.get(slug='generations'), gallery)
+            self.assertNotEqual(lazymodel_cache.local_cache.get(pk_key), None)
+
+            PhotoGallery.objects.filter(pk=gallery.pk).update(slug='updated')
+            self.assertNotEqual(pk_key, model_cache_key(gallery))
+            self.assertNotEqual(lookup_key, lookup_cache_key(PhotoGallery, slug='generations'))
+            with self.assertNumQueries(1):
+                self.assertEqual(PhotoGallery.objects.get(pk=gallery.pk).slug, 'updated')
+            self.assertRaises(PhotoGallery.DoesNotExist, PhotoGallery.objects.get, slug='generations')
+        finally:
+            lazymodel_cache.local_cache = local_cache
+            del settings.LAZYMODEL_GENERATIONS
+
+    def test_key_registry(self):
+        """
+        Ensure that the precomputed key prefixes build the same keys as
+        before, and change when the cache key version changes.
+
+        """
+
+        user = User.objects.all()[0]
+        identifier = get_identifier(user)
+
+        pk_key = model_cache_key(user)
+        self.assertEqual(pk_key, model_keys.key_for(User, user.pk))
+        self.assertEqual(pk_key, model_keys.key_for(user, user.pk))
+        self.assertEqual(pk_key, model_cache_key(identifier))
+        self.assertEqual(pk_key, '%s:%s:%s' % ('ModelCache', settings.CACHE_KEY_VERSIONS['model_cache'], identifier))
+        self.assertEqual(model_keys.keys_for(User, [user.pk, 'a b']), [pk_key, model_cache_key(User, 'ab')])
+
+        cache_version = settings.CACHE_KEY_VERSIONS['model_cache']
+        settings.CACHE_KEY_VERSIONS['model_cache'] = cache_version + 'test'
+        try:
+            self.assertNotEqual(pk_key, model_keys.key_for(User, user.pk))
+        finally:
+            settings.CACHE_KEY_VERSIONS['model_cache'] = cache_version
+
+        # Long keys are shortened to fit within the memcached limit.
+        long_key = model_cache_key(User, 'x' * 300)
+        self.assertTrue(len(long_key) <= 250)
+        self.assertTrue(long_key.startswith(pk_key.rsplit('.', 1)[0]))
+
+        # Keys that are not model identifiers keep their original format,
+        # and their prefixes are not remembered.
+        version = settings.CACHE_KEY_VERSIONS['model_cache']
+        self.assertEqual(versioned_cache_key('Custom', 'abc'), 'Custom:%s:abc' % version)
+        self.assertEqual(versioned_cache_key('Custom', 'a.b.c'), 'Custom:%s:a.b.c' % version)
+        self.assertFalse(('Custom', 'a.b') in model_keys._prefixes)
+
+    def test_lookup_hashing(self):
+        """
+        Ensure that lookup cache keys are stable, and the same for lookups
+        that are written differently but mean the same thing.
+
+        """
+
+        # The hash must not change between processes or Python versions.
+        self.assertEqual(lookup_hasher.hash(User, {'username': u'admin'}), '50a02270c7c0ce906e28acfa540082c2')
+
+        user = User.objects.all()[0]
+        lookup_key = lookup_cache_key(User, pk=user.pk)
+        self.assertEqual(lookup_key, lookup_cache_key(User, id=str(user.pk)))
+        self.assertEqual(lookup_key, lookup_cache_key(User, id__exact=user))
+        self.assertTrue(lookup_key.startswith('ModelCacheLookup:%s:auth.user.' % settings.CACHE_KEY_VERSIONS['model_cache']))
+
+        self.assertNotEqual(
+            lookup_cache_key(User, first_name='a', last_name='bc'),
+            lookup_cache_key(User, first_name='ab', last_name='c'),
+        )
+        self.assertNotEqual(
+            lookup_cache_key(User, username='a'),
+            lookup_cache_key(User, first_name='a'),
+        )
+        self.assertNotEqual(
+            lookup_cache_key(User, last_login=None),
+            lookup_cache_key(User, last_login='None'),
+        )
+        self.assertNotEqual(
+            lookup_cache_key(User, is_staff=True),
+            lookup_cache_key(User, is_staff='True'),
+        )
+        self.assertNotEqual(
+            lookup_cache_key(User, is_staff=False),
+            lookup_cache_key(User, is_staff='False'),
+        )
+
+    def test_lookup_index(self):
+        """
+        Ensure that lookups registered at the same time are all kept in the
+        index, and that a lookup is deleted if its index stays locked.
+
+        """
+
+        user = User.objects.all()[0]
+        lookup_keys = [lookup_cache_key(User, username=user.username, first_name=str(i)) for i in range(10)]
+        for lookup_key in lookup_keys:
+            lazymodel_cache[lookup_key] = user.pk
+
+        threads = [
+            threading.Thread(target=register_lookup_key, args=(User, user.pk, lookup_key))
+            for lookup_key in lookup_keys
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        index_key, indexed_keys = get_lookup_keys(user)
+        self.assertEqual(sorted(indexed_keys), sorted(lookup_keys))
+
+        lookup_key = lookup_cache_key(User, username=user.username, first_name='locked')
+        lazymodel_cache[lookup_key] = user.pk
+        lazymodel_cache.cache.add('%s:lock' % index_key, True)
+        lock_attempts = utils.LOOKUP_INDEX_LOCK_ATTEMPTS
+        utils.LOOKUP_INDEX_LOCK_ATTEMPTS = 1
+        try:
+            register_lookup_key(User, user.pk, lookup_key)
+        finally:
+            utils.LOOKUP_INDEX_LOCK_ATTEMPTS = lock_attempts
+            lazymodel_cache.cache.delete('%s:lock' % index_key)
+        self.assertUncached(lookup_key)
+        self.assertEqual(sorted(get_lookup_keys(user)[1]), sorted(lookup_keys))
+
+        user.save()
+        for lookup_key in lookup_keys:
+            self.assertUncached(lookup_key)
+
+        # Lookups that are dropped from a full index are deleted.
+        index_size = utils.LOOKUP_INDEX_SIZE
+        utils.LOOKUP_INDEX_SIZE = 2
+        try:
+            for lookup_key in lookup_keys[:3]:
+                lazymodel_cache[lookup_key] = user.pk
+                register_lookup_key(User, user.pk, lookup_key)
+        finally:
+            utils.LOOKUP_INDEX_SIZE = index_size
+        self.assertUncached(lookup_keys[0], 'A lookup dropped from the index was not deleted!')
+        self.assertEqual(lazymodel_cache[lookup_keys[2]], user.pk)
+        self.assertEqual(sorted(get_lookup_keys(user)[1]), sorted(lookup_keys[1:3]))
+
     def test_cache_sharing(self):
 
         gallery = PhotoGallery.objects.all()[0]
@@ -82,7 +274,7 @@ class ModelCacheTests(TestCase):
 
         """
 
-        gallery = PhotoGallery.objects.all().filter(sites__isnull=False)[0]
+        gallery = PhotoGallery.objects.all().filter(collections__isnull=False)[0]
         self.assertTrue(isinstance(gallery, ModelWithCaching), 'This test needs to test a cached model.')
         for gallery in PhotoGallery.objects.filter(slug=gallery.slug).exclude(pk=gallery.pk):
             gallery.delete()
@@ -108,13 +300,13 @@ class ModelCacheTests(TestCase):
         self.assertEqual(lazymodel_cache[lookup_key], gallery.pk)
         self.assertEqual(lazymodel_cache[pk_key], gallery)
 
-        # Removing a site from the gallery should trigger the m2m signals that
-        # delete the cached object.
-        gallery.sites.remove(gallery.sites.all()[0])
+        # Removing the gallery from a collection should trigger the m2m
+        # signals that delete the cached object.
+        gallery.collections.remove(gallery.collections.all()[0])
         self.assertUncached(pk_key, 'M2M changes did not delete the cached value!')
 
-        # The lookup key will still be there.
-        self.assertEqual(lazymodel_cache[lookup_key], gallery.pk)
+        # The lookup key refers to the object, so it should be deleted too.
+        self.assertUncached(lookup_key, 'M2M changes did not delete the cached lookup!')
 
         # Saving the object should also delete the cached object.
         # First access the object to add it back to the cache.
@@ -129,6 +321,271 @@ class ModelCacheTests(TestCase):
         gallery.delete()
         self.assertUncached(pk_key, 'Deleting did not delete the cached value!')
 
+    def test_negative_caching(self):
+        """
+        Ensure that missing objects are cached as None when negative caching
+        is enabled, and that saving the object removes the cached None.
+
+        """
+
+        gallery = PhotoGallery.objects.create(slug='negative')
+        missing_pk = gallery.pk + 1
+        pk_key = model_cache_key(PhotoGallery, missing_pk)
+
+        # Earlier tests may have cached a row with this pk, which was rolled
+        # back from the database but not from the cache.
+        del lazymodel_cache[pk_key]
+
+        lazymodel_cache.negative_timeout = 60
+        try:
+            with self.assertNumQueries(1):
+                self.assertRaises(PhotoGallery.DoesNotExist, PhotoGallery.objects.get, pk=missing_pk)
+            self.assertEqual(lazymodel_cache[pk_key], None)
+            with self.assertNumQueries(0):
+                self.assertRaises(PhotoGallery.DoesNotExist, PhotoGallery.objects.get, pk=missing_pk)
+
+            new_gallery = PhotoGallery.objects.create(pk=missing_pk, slug='created')
+            self.assertUncached(pk_key, 'Saving did not delete the cached None!')
+            self.assertEqual(PhotoGallery.objects.get(pk=missing_pk), new_gallery)
+
+            # Other lookups are cached as missing too, so waiting requests
+            # find the cached None instead of doing the query again.
+            lookup_key = lookup_cache_key(PhotoGallery, slug='never-created')
+            del lazymodel_cache[lookup_key]
+            with self.assertNumQueries(1):
+                self.assertRaises(PhotoGallery.DoesNotExist, PhotoGallery.objects.get, slug='never-created')
+            self.assertEqual(lazymodel_cache[lookup_key], None)
+            with self.assertNumQueries(0):
+                self.assertRaises(PhotoGallery.DoesNotExist, PhotoGallery.objects.get, slug='never-created')
+        finally:
+            lazymodel_cache.negative_timeout = None
+
+    def test_stale_lookup(self):
+        """
+        Ensure that a cached lookup which no longer matches its object is
+        done again, without caching a different object under its pk.
+
+        """
+
+        old_gallery = PhotoGallery.objects.create(slug='moving')
+        old_pk_key = model_cache_key(old_gallery)
+        self.assertEqual(PhotoGallery.objects.get(slug='moving'), old_gallery)
+
+        # Change the slugs without sending signals, so the lookup is stale.
+        PhotoGallery.objects.filter(pk=old_gallery.pk).update(slug='moved')
+        new_gallery = PhotoGallery.objects.create(slug='moving')
+        del lazymodel_cache[old_pk_key]
+
+        self.assertEqual(PhotoGallery.objects.get(slug='moving'), new_gallery)
+        self.assertUncached(old_pk_key, 'A stale lookup cached the wrong object!')
+        self.assertEqual(lazymodel_cache[lookup_cache_key(PhotoGallery, slug='moving')], new_gallery.pk)
+        self.assertEqual(PhotoGallery.objects.get(pk=old_gallery.pk).slug, 'moved')
+
+    def test_get_list(self):
+        """
+        Ensure that objects can be fetched together by pk, and are returned
+        in the same order, with missing objects left out.
+
+        """
+
+        galleries = [PhotoGallery.objects.create(slug='list%d' % number) for number in range(3)]
+        pks = [gallery.pk for gallery in reversed(galleries)]
+        missing_pk = galleries[-1].pk + 100
+        del lazymodel_cache[model_cache_key(PhotoGallery, missing_pk)]
+        PhotoGallery.objects.get(pk=galleries[1].pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(PhotoGallery.objects.get_list(pks + [missing_pk]), galleries[::-1])
+        for gallery in galleries:
+            self.assertEqual(lazymodel_cache[model_cache_key(gallery)], gallery)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(PhotoGallery.objects.get_list([str(pk) for pk in pks]), galleries[::-1])
+            in_bulk = PhotoGallery.objects.in_bulk(pks)
+        self.assertEqual(in_bulk, dict((gallery.pk, gallery) for gallery in galleries))
+        self.assertEqual(PhotoGallery.objects.get_list([]), [])
+
+    def test_related_in_bulk(self):
+        """
+        Ensure that related managers only return their own objects from
+        in_bulk and get_list, even when other objects are cached.
+
+        """
+
+        collection = GalleryCollection.objects.create()
+        own_gallery = PhotoGallery.objects.create(slug='own')
+        collection.galleries.add(own_gallery)
+        other_gallery = PhotoGallery.objects.create(slug='other')
+        pks = [other_gallery.pk, own_gallery.pk]
+
+        PhotoGallery.objects.get_list(pks)
+        self.assertEqual(collection.galleries.in_bulk(pks), {own_gallery.pk: own_gallery})
+        self.assertEqual(collection.galleries.get_list([str(pk) for pk in pks]), [own_gallery])
+        self.assertEqual(PhotoGallery.objects.in_bulk(pks), {own_gallery.pk: own_gallery, other_gallery.pk: other_gallery})
+
+    def test_manager_query_set(self):
+        """
+        Ensure that RowCacheManager keeps the filtering and QuerySet class
+        of the managers that it is mixed into.
+
+        """
+
+        class PublishedQuerySet(QuerySet):
+            def published(self):
+                return self.filter(slug='published')
+
+        class PublishedManager(models.Manager):
+            def get_query_set(self):
+                return PublishedQuerySet(self.model, using=self._db).published()
+
+        class CachedPublishedManager(RowCacheManager, PublishedManager):
+            pass
+
+        published = PhotoGallery.objects.create(slug='published')
+        PhotoGallery.objects.create(slug='draft')
+
+        manager = CachedPublishedManager()
+        manager.model = PhotoGallery
+        queryset = manager.get_query_set()
+        self.assertTrue(isinstance(queryset, PublishedQuerySet))
+        self.assertTrue(isinstance(queryset, RowCacheQuerySet))
+        self.assertEqual(list(queryset), [published])
+        self.assertEqual(manager.get_query_set().__class__, queryset.__class__)
+
+        # Managers that do not change get_query_set build the QuerySet
+        # directly, without cloning another one.
+        manager = RowCacheManager()
+        manager.model = PhotoGallery
+        clones = []
+
+        def clone(queryset, *args, **kwargs):
+            clones.append(queryset)
+            return QuerySet._clone(queryset, *args, **kwargs)
+
+        RowCacheQuerySet._clone = clone
+        try:
+            self.assertTrue(manager.get_query_set().__class__ is RowCacheQuerySet)
+        finally:
+            del RowCacheQuerySet._clone
+        self.assertEqual(clones, [])
+
+    def test_related_negative_caching(self):
+        """
+        Ensure that related managers do not cache objects as missing when
+        they exist but are not related.
+
+        """
+
+        collection = GalleryCollection.objects.create()
+        gallery = PhotoGallery.objects.create(slug='unrelated')
+        pk_key = model_cache_key(gallery)
+        del lazymodel_cache[pk_key]
+
+        lazymodel_cache.negative_timeout = 60
+        try:
+            self.assertRaises(PhotoGallery.DoesNotExist, collection.galleries.get, pk=gallery.pk)
+            self.assertUncached(pk_key, 'A related manager cached an existing object as missing!')
+            self.assertEqual(PhotoGallery.objects.get(pk=gallery.pk), gallery)
+            self.assertEqual(LazyModel(PhotoGallery, gallery.pk), gallery)
+        finally:
+            lazymodel_cache.negative_timeout = None
+
+    def test_prefetch_cached(self):
+        """
+        Ensure that related objects are fetched together and attached to
+        the objects, so that accessing them afterwards does nothing.
+
+        """
+
+        permissions = list(Permission.objects.order_by('pk')[:10])
+        content_types = [ContentType.objects.get(pk=permission.content_type_id) for permission in permissions]
+
+        lazymodel_cache.delete(model_cache_key(ContentType, content_types[0].pk))
+        self.assertNumQueries(1, prefetch_cached, permissions, 'content_type')
+        with self.assertNumQueries(0):
+            self.assertEqual([permission.content_type for permission in permissions], content_types)
+
+        permissions = list(Permission.objects.order_by('pk')[:10])
+        self.assertNumQueries(0, prefetch_cached, permissions, 'content_type')
+
+    def test_deferred_invalidation(self):
+        """
+        Ensure that changed objects are deleted from the cache at the end
+        of a deferred block, rather than straight away.
+
+        """
+
+        users = list(User.objects.order_by('pk')[:3])
+        LazyModel.resolve_many([LazyModel(User, user.pk) for user in users])
+
+        with lazymodel_invalidation.deferred():
+            for user in users:
+                user.save()
+                user.save()
+            self.assertEqual(lazymodel_cache[model_cache_key(users[0])], users[0])
+
+        for user in users:
+            self.assertUncached(model_cache_key(user))
+
+    def test_invalidation_calls(self):
+        """
+        Ensure that saving or deleting an object only updates the cache once,
+        with one call for the lookup index and one to delete the keys, and
+        that everything changed in commit_on_success is handled together
+        once it has finished.
+
+        """
+
+        gallery = PhotoGallery.objects.create(slug='calls')
+        PhotoGallery.objects.get(slug='calls')
+        others = [PhotoGallery.objects.create(slug='calls%d' % number) for number in range(3)]
+
+        backend = lazymodel_cache.cache
+        calls = []
+
+        class CountingCache(object):
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(backend, name)
+
+        lazymodel_cache.cache = CountingCache()
+        try:
+            gallery.save()
+            self.assertEqual(calls, ['get_many', 'delete_many'])
+            del calls[:]
+            gallery.delete()
+            self.assertEqual(calls, ['get_many', 'delete_many'])
+
+            del calls[:]
+            with lazymodel_invalidation.commit_on_success():
+                for other in others:
+                    other.save()
+                    other.save()
+                others[0].delete()
+                self.assertEqual(calls, [])
+            self.assertEqual(calls, ['get_many', 'delete_many'])
+        finally:
+            lazymodel_cache.cache = backend
+
+    def test_transaction_middleware(self):
+        """
+        Ensure that objects changed during a request are deleted from the
+        cache once the middleware has finished the transaction.
+
+        """
+
+        gallery = PhotoGallery.objects.create(slug='middleware')
+        pk_key = model_cache_key(gallery)
+        self.assertEqual(PhotoGallery.objects.get(pk=gallery.pk), gallery)
+
+        middleware = TransactionMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        gallery.save()
+        self.assertEqual(lazymodel_cache[pk_key], gallery)
+        middleware.process_response(request, HttpResponse())
+        self.assertUncached(pk_key)
+
     def test_saving_content_type(self):
         """
         The model cache key stuff has special handling to allow passing in a
@@ -239,3 +696,196 @@ class LazyModelTests(TestCase):
         users.get_or_add(user2)
         self.assertEqual(len(users), 2)
         self.assertTrue(LazyModel.get_identifier(user2) in users)
+
+    def test_resolve_many(self):
+
+        users = list(User.objects.all()[:3])
+        missing_pk = max(user.pk for user in users) + 10000000
+
+        for user in users:
+            del lazymodel_cache[model_cache_key(user)]
+        del lazymodel_cache[model_cache_key(User, missing_pk)]
+
+        lazy_users = [LazyModel(User, user.pk) for user in users]
+        lazy_missing = LazyModel(User, missing_pk)
+
+        # Resolving them should evaluate every instance
+        # and add the results to the cache.
+        LazyModel.resolve_many(lazy_users + [lazy_missing])
+        for user, lazy_user in zip(users, lazy_users):
+            self.assertEqual(lazy_user._wrapped, user)
+            self.assertEqual(lazymodel_cache[model_cache_key(user)], user)
+        self.assertFalse(lazy_missing)
+        self.assertEqual(lazymodel_cache[model_cache_key(User, missing_pk)], None)
+
+        # The dictionary version should replace missing objects with None.
+        items = LazyModelDict()
+        for user in users:
+            items.add_lazy(User, user.pk)
+        items.add_lazy(User, missing_pk)
+        items.resolve_all()
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[get_identifier(User, missing_pk)], None)
+        for user in users:
+            self.assertEqual(items[get_identifier(user)], user)
+
+    def test_cache_backends(self):
+        """
+        Ensure that a Django cache or a dictionary can still be used as the
+        cache backend, by being wrapped in a LazyCache.
+
+        """
+
+        user = User.objects.all()[0]
+        cache_key = model_cache_key(user)
+
+        backend = {}
+        self.assertEqual(LazyModel(User, user.pk, cache_backend=backend), user)
+        self.assertEqual(backend[cache_key], user)
+        backend[cache_key] = 'dummy value for the cache'
+        self.assertEqual(LazyModel(User, user.pk, cache_backend=backend), 'dummy value for the cache')
+
+        # Dictionaries are not kept alive by the wrapper.
+        lazy_caches = len(lazycache._lazy_caches)
+        for count in range(10):
+            LazyModel(User, user.pk, cache_backend={})
+        self.assertEqual(len(lazycache._lazy_caches), lazy_caches)
+
+        cache.delete(cache_key)
+        self.assertEqual(LazyModel(User, user.pk, cache_backend=cache), user)
+        self.assertEqual(cache.get(cache_key), user)
+
+    def test_aresolve(self):
+
+        users = list(User.objects.all()[:2])
+
+        result = LazyModel(users[0]).aresolve()
+        self.assertEqual(result.get(), users[0])
+
+        lazy_users = LazyModel.aresolve_many(LazyModel(User, user.pk) for user in users).get()
+        self.assertEqual([lazy_user._wrapped for lazy_user in lazy_users], users)
+
+
+class WriteThroughTests(TransactionTestCase):
+
+    def assertUncached(self, cache_key):
+        self.assertRaises(KeyError, lambda: lazymodel_cache[cache_key])
+
+    def test_write_through(self):
+        """
+        Ensure that saved objects replace their cached versions when write
+        through is enabled, and that their cached lookups are deleted.
+
+        """
+
+        user = User.objects.create(username='writethrough')
+        pk_key = model_cache_key(user)
+        lookup_key = lookup_cache_key(User, username='writethrough')
+
+        settings.LAZYMODEL_WRITE_THROUGH = ['auth.user']
+        try:
+            self.assertEqual(User.objects.get(username='writethrough'), user)
+            user.username = 'changed'
+            user.save()
+            self.assertEqual(lazymodel_cache[pk_key].username, 'changed')
+            self.assertUncached(lookup_key)
+        finally:
+            del settings.LAZYMODEL_WRITE_THROUGH
+
+        user.save()
+        self.assertUncached(pk_key)
+
+    def test_write_through_transactions(self):
+        """
+        Ensure that objects saved in a transaction are written through to the
+        cache once it has been committed, and never if it gets rolled back.
+
+        """
+
+        user = User.objects.create(username='transaction')
+        pk_key = model_cache_key(user)
+
+        settings.LAZYMODEL_WRITE_THROUGH = ['auth.user']
+        try:
+            self.assertEqual(User.objects.get(pk=user.pk), user)
+
+            # Without waiting for the transaction, it falls back to deleting.
+            with transaction.commit_manually():
+                user.username = 'rolledback'
+                user.save()
+                transaction.rollback()
+            self.assertUncached(pk_key)
+            self.assertEqual(LazyModel(User, user.pk).username, 'transaction')
+
+            with lazymodel_invalidation.commit_on_success():
+                user.username = 'committed'
+                user.save()
+                self.assertEqual(lazymodel_cache[pk_key].username, 'transaction')
+            self.assertEqual(lazymodel_cache[pk_key].username, 'committed')
+
+            def save_and_fail():
+                with lazymodel_invalidation.commit_on_success():
+                    user.username = 'failed'
+                    user.save()
+                    raise ValueError
+            self.assertRaises(ValueError, save_and_fail)
+            self.assertUncached(pk_key)
+            self.assertEqual(User.objects.get(pk=user.pk).username, 'committed')
+        finally:
+            del settings.LAZYMODEL_WRITE_THROUGH
+
+
+class SerializerTests(TestCase):
+
+    def test_field_tuple_serializer(self):
+
+        serializer = FieldTupleSerializer()
+        user = User.objects.all()[0]
+
+        packed = serializer.dumps(user)
+        self.assertTrue(len(pickle.dumps(packed, -1)) < len(pickle.dumps(user, -1)))
+
+        unpacked = serializer.loads(pickle.loads(pickle.dumps(packed, -1)))
+        self.assertEqual(unpacked, user)
+        self.assertFalse(unpacked._state.adding)
+        for field in User._meta.fields:
+            self.assertEqual(getattr(unpacked, field.attname), getattr(user, field.attname))
+
+        # Other values are left alone.
+        self.assertEqual(serializer.loads(serializer.dumps(123)), 123)
+
+        # Values from a different schema are rejected.
+        serializer._schemas[User] = 0
+        self.assertRaises(ValueError, serializer.loads, packed)
+
+
+class ModelCachedListTests(TestCase):
+
+    def test_model_cached_list(self):
+
+        users = list(User.objects.order_by('pk')[:5])
+        user_cache = ModelCachedList.from_queryset(User.objects.order_by('pk')[:5])
+
+        # Pickling the list caches its items using the row cache keys.
+        pickled = pickle.dumps(user_cache)
+        for user in users:
+            self.assertEqual(lazymodel_cache[model_cache_key(user)], user)
+
+        user_cache = pickle.loads(pickled)
+        self.assertEqual(user_cache.model, User)
+        self.assertEqual(list(user_cache), users)
+
+        # Missing items are rebuilt and added back to the row cache.
+        del lazymodel_cache[model_cache_key(users[0])]
+        user_cache = pickle.loads(pickled)
+        self.assertEqual(list(user_cache), users)
+        self.assertEqual(lazymodel_cache[model_cache_key(users[0])], users[0])
+        self.assertEqual(LazyModel(User, users[0].pk), users[0])
+
+        # Caching the list again does not replace newer cached objects.
+        saved_user = User.objects.get(pk=users[1].pk)
+        saved_user.first_name = 'saved since the list was loaded'
+        lazymodel_cache[model_cache_key(saved_user)] = saved_user
+        user_cache.cache('model-cached-list')
+        pickle.dumps(user_cache)
+        self.assertEqual(lazymodel_cache[model_cache_key(saved_user)].first_name, saved_user.first_name)
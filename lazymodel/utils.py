@@ -1,46 +1,134 @@
 import inspect
 import hashlib
 import re
+import time
 
-from django.conf import settings
+from django.conf import BaseSettings, settings
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Model
+from django.db import transaction
+from django.db.models import Model, get_model as get_model_by_label
 from django.utils.encoding import force_unicode
 
-from lazymodel.backend import lazymodel_cache
+from lazycache import Envelope
+from lazymodel.backend import lazymodel_cache, lazymodel_generations
 
 
 IDENTIFIER_REGEX = re.compile('^[\w\d_]+\.[\w\d_]+\.[\w\d]+$')
 
+# The maximum number of lookups to remember for each object,
+# so they can be deleted when the object changes.
+LOOKUP_INDEX_SIZE = 100
 
-class HashableTuple(tuple):
+# How long an index may be locked while adding a lookup to it,
+# and how many times to try to get the lock.
+LOOKUP_INDEX_LOCK_TIMEOUT = 5
+LOOKUP_INDEX_LOCK_ATTEMPTS = 10
 
-    def __new__(cls, *items):
-        return tuple.__new__(cls, cls._create_sequence(items))
 
-    @classmethod
-    def _create_one(cls, item):
-        if isinstance(item, cls):
-            return item
-        elif isinstance(item, (list, tuple, set)):
-            return tuple(cls._create_sequence(*item))
-        if isinstance(item, dict):
-            return tuple((key, cls._create_one(value)) for (key, value) in sorted(item.items()))
-        elif inspect.isclass(item) or inspect.isfunction(item) or inspect.ismethod(item):
-            return item.__name__
-        elif isinstance(item, (int, basestring)):
-            return force_unicode(item)
-        else:
-            return item
+def encode_lookup_value(value):
+    """
+    Encode a lookup value as a UTF-8 string, prefixed with its length so
+    that the encoded values of several lookups cannot be confused. Numbers
+    and strings are treated the same way (pk=1 and pk="1" are the same
+    lookup) and model instances are replaced by their pk. None, True and
+    False have their own tags, so they are not confused with the strings
+    "None", "True" and "False".
+
+    """
+
+    if value is None:
+        return 'N'
+    elif isinstance(value, bool):
+        return value and 'T' or 'F'
+    elif isinstance(value, unicode):
+        text = value
+    elif isinstance(value, (str, int, long)):
+        text = force_unicode(value)
+    elif isinstance(value, Model):
+        text = force_unicode(value._get_pk_val())
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ''.join(encode_lookup_value(item) for item in value)
+    elif isinstance(value, (set, frozenset)):
+        return '{%s}' % ''.join(sorted(encode_lookup_value(item) for item in value))
+    elif isinstance(value, dict):
+        return '{%s}' % ''.join(sorted(
+            encode_lookup_value(key) + encode_lookup_value(item)
+            for (key, item) in value.items()
+        ))
+    elif inspect.isclass(value) or inspect.isfunction(value) or inspect.ismethod(value):
+        text = force_unicode(value.__name__)
+    else:
+        text = force_unicode(value)
+    data = text.encode('utf-8')
+    return '%d:%s' % (len(data), data)
+
+
+class LookupHasher(object):
+    """
+    Hashes the keyword arguments of a lookup, such as get(slug="hello"),
+    for use in lookup cache keys.
 
-    @classmethod
-    def _create_sequence(cls, *items):
-        for item in items:
-            yield cls._create_one(item)
+    The field names of each lookup are put into a canonical form once and
+    remembered for each model and set of names: they are sorted, "pk" is
+    replaced with the name of the primary key field, and "__exact" is
+    removed. After that, only the values need to be encoded.
+
+    The hash is an MD5 digest of the encoded lookup. It is not used for
+    security, but it is quick, and unlike hash() it is the same across
+    processes, platforms and Python versions, which the cache keys need.
+
+    """
+
+    def __init__(self):
+        self._signatures = {}
+
+    def get_signature(self, model, names):
+        """
+        Returns the canonical form of the field names of a lookup, and
+        the original names in the order that their values are encoded.
+
+        """
+        try:
+            return self._signatures[model, names]
+        except KeyError:
+            pk_name = get_model_class(model)._meta.pk.name
+            fields = []
+            for name in names:
+                field = name
+                if field.endswith('__exact'):
+                    field = field[:-len('__exact')]
+                if field == 'pk' or field.startswith('pk__'):
+                    field = pk_name + field[2:]
+                fields.append((field, name))
+            fields.sort()
+            signature = (
+                encode_lookup_value([item[0] for item in fields]),
+                tuple(item[1] for item in fields),
+            )
+            self._signatures[model, names] = signature
+            return signature
 
-    @property
-    def hash(self):
-        return hashlib.sha256(repr(self)).hexdigest()
+    def hash(self, model, kwargs):
+        signature, names = self.get_signature(model, tuple(kwargs))
+        data = signature + ''.join([encode_lookup_value(kwargs[name]) for name in names])
+        return hashlib.md5(data).hexdigest()
+
+
+lookup_hasher = LookupHasher()
+
+
+def get_settings():
+    """
+    Returns the settings object that django.conf.settings is wrapping.
+    Reading attributes from it is much faster than going through the
+    lazy wrapper, which matters for code that runs for every cache key.
+
+    """
+    wrapped = settings._wrapped
+    if not isinstance(wrapped, BaseSettings):
+        settings._setup()
+        wrapped = settings._wrapped
+    return wrapped
 
 
 def get_model(obj):
@@ -54,6 +142,14 @@ def get_model(obj):
     return obj
 
 
+def get_model_class(obj):
+    """Returns the model class of a model class, instance or content type."""
+    model = get_model(obj)
+    if isinstance(model, Model):
+        return model.__class__
+    return model
+
+
 def get_identifier(obj_or_string, pk=None, **kwargs):
     """
     Get an unique identifier for a database object or model + pk,
@@ -95,27 +191,320 @@ def get_identifier_string(model, pk):
 
 def get_object_pk(model, **kwargs):
     cache_key = lookup_cache_key(model, **kwargs)
-    object_pk = lazymodel_cache.get_or_miss(cache_key)
-    if object_pk is lazymodel_cache.missed:
+
+    fetched = []
+
+    def get_pk():
         try:
             object_pk = model.objects.get(**kwargs).pk
         except model.DoesNotExist:
-            object_pk = None
-        lazymodel_cache[cache_key] = object_pk
+            return None
+        fetched.append(object_pk)
+        return object_pk
+
+    object_pk = lazymodel_cache.get_or_set(cache_key, get_pk)
+    if fetched:
+        # The lookup has been cached, so it can be added to the index.
+        register_lookup_key(model, object_pk, cache_key)
     return object_pk
 
 
+def get_model_label(model):
+    """Returns the "app_label.model" label of a model, content type or identifier."""
+    if isinstance(model, basestring):
+        return '.'.join(model.split('.', 2)[:2])
+    model = get_model(model)
+    return u'%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def generations_enabled(model_label):
+    """
+    Check if generation numbers are used in the cache keys of a model,
+    using the LAZYMODEL_GENERATIONS setting. This can be True to use them
+    for all models, or a list of model labels such as ["auth.user"].
+
+    """
+    enabled = getattr(settings, 'LAZYMODEL_GENERATIONS', False)
+    if enabled is True:
+        return True
+    return bool(enabled) and model_label in enabled
+
+
+def write_through_enabled(model_label):
+    """
+    Check if saved objects of a model are written to the cache, rather than
+    deleted from it, using the LAZYMODEL_WRITE_THROUGH setting. This can be
+    True to enable it for all models, or a list of model labels such as
+    ["auth.user"].
+
+    """
+    enabled = getattr(settings, 'LAZYMODEL_WRITE_THROUGH', False)
+    if enabled is True:
+        return True
+    return bool(enabled) and model_label in enabled
+
+
+def in_transaction(using=None):
+    """Check if changes to the database might still be rolled back."""
+    if hasattr(transaction, 'get_autocommit'):
+        return not transaction.get_autocommit(using=using)
+    return transaction.is_managed(using=using)
+
+
+def invalidate_model(model):
+    """
+    Invalidate all cached objects and lookups of a model in one operation,
+    by incrementing the generation number used in its cache keys. Use this
+    after changing objects without sending signals, such as with raw SQL.
+    RowCacheManager does this automatically for QuerySet.update and
+    bulk_create. This does nothing if generations are not enabled for
+    the model.
+
+    """
+    model_label = get_model_label(model)
+    if generations_enabled(model_label):
+        lazymodel_generations.bump(model_label)
+
+
+class KeyRegistry(object):
+    """
+    Builds cache keys from prefixes that are computed once for each
+    namespace and model, e.g. "ModelCache:1:auth.user.", rather than
+    formatting every part of every key. The prefixes are rebuilt when
+    the CACHE_KEY_VERSIONS, VERSION or LAZYMODEL_GENERATIONS settings
+    change. Models with generations enabled still get the current
+    generation number for every key.
+
+    Keys longer than max_length (the memcached limit by default) are
+    shortened by replacing the object pk with its MD5 hash.
+
+    Prefixes are only remembered for models that Django knows about, so
+    building keys for arbitrary labels cannot use up memory. get_prefix
+    returns None for labels that are not models.
+
+    Usage:
+        model_keys.key_for(User, 123)
+        model_keys.keys_for(User, [123, 456])
+
+    """
+
+    def __init__(self, max_length=250):
+        self.max_length = max_length
+        self._state = None
+        self._prefixes = {}
+
+    def refresh(self):
+        """Forget the prefixes, so they will be built again when needed."""
+        self._state = None
+
+    def get_prefix(self, namespace, model):
+        """
+        Returns the key prefix for a namespace and a model class or
+        "app_label.model" label, or None if the label is not a model.
+
+        """
+
+        state = self.get_state()
+
+        try:
+            prefix, model_label = self._prefixes[namespace, model]
+        except KeyError:
+            if isinstance(model, basestring):
+                model_label = model
+                if get_model_by_label(*model.split('.', 1)) is None:
+                    return None
+            else:
+                model_label = get_model_label(model)
+            if generations_enabled(model_label):
+                prefix = None
+            else:
+                prefix = '%s:%s:%s.' % (namespace, state[0], model_label)
+            self._prefixes[namespace, model] = (prefix, model_label)
+
+        if prefix is None:
+            generation = lazymodel_generations.get(model_label)
+            prefix = '%s:%s:%s:%s.' % (namespace, state[0], generation, model_label)
+
+        return prefix
+
+    def get_state(self):
+        """
+        Returns the cache key version and generation settings, and forgets
+        the prefixes if they have changed.
+
+        """
+        current_settings = get_settings()
+        versions = getattr(current_settings, 'CACHE_KEY_VERSIONS', None) or {}
+        generations = getattr(current_settings, 'LAZYMODEL_GENERATIONS', False)
+        if isinstance(generations, (list, tuple, set)):
+            generations = tuple(generations)
+        state = (versions.get('model_cache') or current_settings.VERSION, generations)
+        if state != self._state:
+            self._prefixes = {}
+            self._state = state
+        return state
+
+    def make_key(self, prefix, object_id):
+        key = prefix + object_id
+        if self.max_length and len(key) > self.max_length:
+            if isinstance(object_id, unicode):
+                object_id = object_id.encode('utf-8')
+            key = prefix + hashlib.md5(object_id).hexdigest()
+        return key
+
+    def key_for(self, model, pk, namespace='ModelCache'):
+        """
+        Returns the cache key for an object, given its model (a model class,
+        instance or content type) and pk. This matches model_cache_key.
+
+        """
+        prefix = self.get_prefix(namespace, get_model_class(model))
+        return self.make_key(prefix, str(pk).replace(' ', ''))
+
+    def keys_for(self, model, pks, namespace='ModelCache'):
+        """Returns the cache keys for many objects of the same model."""
+        prefix = self.get_prefix(namespace, get_model_class(model))
+        return [self.make_key(prefix, str(pk).replace(' ', '')) for pk in pks]
+
+
+model_keys = KeyRegistry(
+    max_length=getattr(settings, 'LAZYMODEL_MAX_KEY_LENGTH', 250),
+)
+
+
 def versioned_cache_key(namespace, cache_key):
-    versions = getattr(settings, 'CACHE_KEY_VERSIONS', {})
-    version = versions.get('model_cache') or settings.VERSION
-    return '%s:%s:%s' % (namespace, version, cache_key)
+    """
+    Returns the versioned cache key for an identifier such as "auth.user.1".
+    Other keys are only prefixed with the namespace and version.
+
+    """
+    if cache_key.count('.') >= 2:
+        model_label = get_model_label(cache_key)
+        prefix = model_keys.get_prefix(namespace, model_label)
+        if prefix is not None:
+            return model_keys.make_key(prefix, cache_key[len(model_label) + 1:])
+    return '%s:%s:%s' % (namespace, model_keys.get_state()[0], cache_key)
 
 
 def model_cache_key(obj_or_string, pk=None, **kwargs):
+    if not kwargs and not isinstance(obj_or_string, basestring):
+        # Skip building the identifier when the model and pk are known.
+        model = get_model(obj_or_string)
+        if pk is None and isinstance(model, Model):
+            pk = model._get_pk_val()
+        return model_keys.key_for(model, pk)
     identifier = get_identifier(obj_or_string, pk=pk, **kwargs)
     return versioned_cache_key('ModelCache', identifier)
 
 
 def lookup_cache_key(model, **kwargs):
-    identifier = get_identifier(model, HashableTuple(kwargs).hash)
-    return versioned_cache_key('ModelCacheLookup', identifier)
+    model = get_model_class(model)
+    prefix = model_keys.get_prefix('ModelCacheLookup', model)
+    return model_keys.make_key(prefix, lookup_hasher.hash(model, kwargs))
+
+
+def lookup_index_key(obj_or_string, pk=None):
+    """
+    Returns the cache key for the index of lookups that have been cached
+    for an object. This is used to delete those lookups when the object
+    is changed or deleted.
+
+    """
+    identifier = get_identifier(obj_or_string, pk=pk)
+    return versioned_cache_key('ModelCacheLookupIndex', identifier)
+
+
+def get_lookup_hashes(value):
+    """
+    Returns the lookup hashes from a stored index. Indexes are stored in
+    the main cache directly, but older ones may have been stored by
+    LazyCache in an Envelope.
+
+    """
+    if isinstance(value, Envelope):
+        value = value.value
+    if isinstance(value, tuple):
+        return value
+    return ()
+
+
+def register_lookup_key(model, object_pk, lookup_key):
+    """
+    Add a lookup cache key to the index of the object that it refers to.
+    Only the hash part of the key is stored, to keep the index small. Call
+    this after the lookup has been cached. The lookup is deleted if the
+    object changes after this call; a change in between caching and
+    registering the lookup is missed, leaving the lookup to expire.
+
+    The index keeps the most recent LOOKUP_INDEX_SIZE lookups. Older ones
+    are deleted when they are dropped from it, since they could no longer
+    be invalidated.
+
+    The index is read and written directly in the main cache, because
+    another process may have added to it since it was cached locally, and
+    a short lock (made with the cache's atomic "add" operation) stops
+    processes from overwriting each other's additions. If the lock cannot
+    be acquired, the lookup is deleted rather than being left out of the
+    index.
+
+    """
+
+    index_key = lookup_index_key(model, object_pk)
+    lookup_hash = lookup_key.rsplit('.', 1)[-1]
+    lock_key = '%s:lock' % index_key
+    cache = lazymodel_cache.cache
+
+    for attempt in xrange(LOOKUP_INDEX_LOCK_ATTEMPTS):
+        if cache.add(lock_key, True, LOOKUP_INDEX_LOCK_TIMEOUT):
+            dropped_hashes = ()
+            try:
+                lookup_hashes = get_lookup_hashes(cache.get(index_key))
+                if lookup_hash not in lookup_hashes:
+                    lookup_hashes = lookup_hashes + (lookup_hash,)
+                    dropped_hashes = lookup_hashes[:-LOOKUP_INDEX_SIZE]
+                    lookup_hashes = lookup_hashes[-LOOKUP_INDEX_SIZE:]
+                    cache.set(index_key, lookup_hashes, lazymodel_cache.default_timeout)
+            finally:
+                cache.delete(lock_key)
+            if dropped_hashes:
+                model_label = get_model_label(model)
+                lazymodel_cache.delete_many([
+                    versioned_cache_key('ModelCacheLookup', '%s.%s' % (model_label, dropped_hash))
+                    for dropped_hash in dropped_hashes
+                ])
+            return
+        time.sleep(0.01 * (attempt + 1))
+
+    lazymodel_cache.delete(lookup_key)
+
+
+def get_lookup_keys(identifier):
+    """
+    Returns the index cache key of an object, and the lookup cache keys
+    that are in the index.
+
+    """
+    index_key = lookup_index_key(identifier)
+    model_label = get_model_label(identifier)
+    lookup_keys = [
+        versioned_cache_key('ModelCacheLookup', '%s.%s' % (model_label, lookup_hash))
+        for lookup_hash in get_lookup_hashes(lazymodel_cache.cache.get(index_key))
+    ]
+    return index_key, lookup_keys
+
+
+def get_invalidation_keys(identifiers):
+    """
+    Returns the index cache keys of many objects, and the lookup cache keys
+    that are in those indexes, using one get_many call for the indexes.
+
+    """
+    index_keys = dict((lookup_index_key(identifier), identifier) for identifier in identifiers)
+    cache_keys = index_keys.keys()
+    for index_key, value in lazymodel_cache.cache.get_many(index_keys.keys()).items():
+        model_label = get_model_label(index_keys[index_key])
+        cache_keys.extend(
+            versioned_cache_key('ModelCacheLookup', '%s.%s' % (model_label, lookup_hash))
+            for lookup_hash in get_lookup_hashes(value)
+        )
+    return cache_keys